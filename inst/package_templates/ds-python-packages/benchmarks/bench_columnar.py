@@ -0,0 +1,91 @@
+"""Time the columnar fetch engine against the default pandas path.
+
+Runs offline: a cursor shaped stand in hands out synthetic rows (int, float,
+str, datetime, and decimal columns) the way pyodbc does, so only the
+conversion to a DataFrame is timed.
+
+    python benchmarks/bench_columnar.py --rows 1000000 --repeat 3
+"""
+
+import argparse
+import datetime
+import decimal
+import random
+from time import perf_counter
+
+from ds.connect.database import _fetch_columnar, _rows_to_frame
+
+
+class FakeCursor:
+    def __init__(self, rows, description):
+        self.rows = rows
+        self.description = description
+        self.at = 0
+
+    def fetchall(self):
+        out, self.at = self.rows[self.at :], len(self.rows)
+        return out
+
+    def fetchmany(self, size):
+        out = self.rows[self.at : self.at + size]
+        self.at += len(out)
+        return out
+
+
+def make_rows(n: int, seed: int = 1):
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    description = [
+        ("id", int),
+        ("score", float),
+        ("name", str),
+        ("created", datetime.datetime),
+        ("amount", decimal.Decimal),
+    ]
+    rows = [
+        (
+            i,
+            rng.random(),
+            "name{}".format(rng.randint(0, 999)),
+            start + datetime.timedelta(seconds=i),
+            decimal.Decimal(rng.randint(0, 10**6)) / 100,
+        )
+        for i in range(n)
+    ]
+    return rows, [(x, y, None, None, None, None, True) for x, y in description]
+
+
+def best_of(repeat: int, fun):
+    times = []
+    for i in range(repeat):
+        begin = perf_counter()
+        fun()
+        times.append(perf_counter() - begin)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rows, description = make_rows(args.rows, args.seed)
+    columns = [x[0] for x in description]
+
+    pandas = best_of(
+        args.repeat,
+        lambda: _rows_to_frame(FakeCursor(rows, description).fetchall(), columns),
+    )
+    columnar = best_of(
+        args.repeat, lambda: _fetch_columnar(FakeCursor(rows, description))
+    )
+
+    print("{:,} rows, best of {}".format(args.rows, args.repeat))
+    print("  fetchall + DataFrame.from_records (pandas): {:.2f}s".format(pandas))
+    print("  columnar engine:                            {:.2f}s".format(columnar))
+
+
+if __name__ == "__main__":
+    main()
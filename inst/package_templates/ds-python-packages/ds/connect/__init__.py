@@ -1,3 +1,10 @@
 from ds.connect.config import Config
-from ds.connect.database import ConnectDatabase
+from ds.connect.database import (
+    ConnectDatabase,
+    UploadBackend,
+    ExecuteManyBackend,
+    BulkInsertBackend,
+    LocalEngineBackend,
+)
+from ds.connect.async_database import AsyncConnectDatabase
 from ds.connect.datalake import ConnectDatalake
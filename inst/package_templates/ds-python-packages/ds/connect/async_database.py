@@ -0,0 +1,262 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from ds.connect.database import ConnectDatabase
+
+
+class AsyncConnectDatabase:
+
+    """
+    Connect & Query Databases from asyncio
+
+    An asyncio front end to ConnectDatabase.  The blocking pyodbc calls run on a managed pool of worker threads (one pooled connection per worker), so the event loop is never stalled.  Cancelling a call, or letting it run past its timeout, also cancels the statement on the server.  Calls beyond `pool_size` (counting each open `iter_query`, which keeps its connection between pages) wait on the event loop for a free connection.
+
+    Parameters:
+        credentials: A named set of credentials (i.e., the named attribute from a config object) as read by ds.connect's Config class
+        database: An existing ConnectDatabase to wrap instead of connecting with `credentials`
+        timeout: The default number of seconds a call may run before it is cancelled; defaults to None (no limit).  Each method also takes `timeout = `
+        **kwargs: Other arguments passed to ConnectDatabase (e.g., `pool_size`, which also sets the number of worker threads)
+
+    Attributes:
+        db: The wrapped ConnectDatabase
+
+    Methods:
+        close: Stop the worker threads and close the connections
+        columns: Coroutine version of ConnectDatabase.columns
+        count: Coroutine version of ConnectDatabase.count
+        database: Coroutine version of ConnectDatabase.database
+        describe: Coroutine version of ConnectDatabase.describe
+        get: Coroutine version of ConnectDatabase.get
+        get_random: Coroutine version of ConnectDatabase.get_random
+        iter_query: Async generator version of ConnectDatabase.iter_query
+        lookup_schema_name: Coroutine version of ConnectDatabase.lookup_schema_name
+        nrow: Coroutine version of ConnectDatabase.nrow
+        query: Coroutine version of ConnectDatabase.query (takes the same `params`, `chunksize`, and `cache`); with `chunksize = ` it returns the async generator of iter_query
+        search: Coroutine version of ConnectDatabase.search
+        server: Coroutine version of ConnectDatabase.server
+        tables: Coroutine version of ConnectDatabase.tables
+        variables: Coroutine version of ConnectDatabase.variables
+        write_table: Coroutine version of ConnectDatabase.write_table
+
+    Examples::
+
+        import asyncio
+        from ds.connect import AsyncConnectDatabase, Config
+
+        crds = Config()
+
+        async def main():
+            async with AsyncConnectDatabase(crds.institutions, timeout = 600) as idb:
+                tables = await idb.tables()
+                insts, counts = await asyncio.gather(
+                    idb.get('Institution', n = 10),
+                    idb.query('SELECT COUNT(*) AS n FROM [dbo].[Institution]')
+                )
+
+                async for chunk in idb.iter_query('SELECT * FROM [dbo].[Institution]', chunksize = 50000):
+                    print(chunk.shape)
+
+        asyncio.run(main())
+    """
+
+    def __init__(
+        self, credentials=None, database=None, timeout: float = None, **kwargs
+    ):
+
+        if database is None:
+            database = ConnectDatabase(credentials, **kwargs)
+        elif not isinstance(database, ConnectDatabase):
+            raise Exception("`database` does not appear to be a ConnectDatabase")
+
+        self.db = database
+        self.timeout = timeout
+        self._slots = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.db._pool.size, thread_name_prefix="ds-async"
+        )
+
+    def __repr__(self):
+        return repr(self.db)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+        self.db.close()
+
+    async def query(
+        self,
+        query=None,
+        results=True,
+        chunksize: int = None,
+        engine: str = "pandas",
+        cache: bool = False,
+        params: list = None,
+        timeout=None,
+    ):
+        ## Pages come from the async generator, which runs each fetch on a
+        ## worker (the sync generator would fetch on the event loop)
+        if (chunksize is not None) and (results is True) and not cache:
+            return self.iter_query(
+                query,
+                chunksize=chunksize,
+                engine=engine,
+                params=params,
+                timeout=timeout,
+            )
+
+        return await self._run(
+            self.db.query,
+            query,
+            results=results,
+            chunksize=chunksize,
+            engine=engine,
+            cache=cache,
+            params=params,
+            timeout=timeout,
+        )
+
+    async def iter_query(
+        self,
+        query,
+        chunksize: int = 100000,
+        engine: str = "pandas",
+        params: list = None,
+        timeout=None,
+    ):
+        ## The iterator keeps its connection (and so its slot) across awaits;
+        ## its page fetches run in that slot rather than asking for another
+        slots = self._connection_slots()
+        await slots.acquire()
+        try:
+            ## Page fetches reuse the statement's cursor, so keep it for
+            ## cancelling
+            cursors = []
+            pages = await self._run(
+                self.db.iter_query,
+                query,
+                chunksize=chunksize,
+                engine=engine,
+                params=params,
+                timeout=timeout,
+                cursors=cursors,
+                slot=False,
+            )
+
+            try:
+                while True:
+                    page = await self._run(
+                        next, pages, None, timeout=timeout, cursors=cursors, slot=False
+                    )
+                    if page is None:
+                        break
+                    yield page
+            finally:
+                # hands the connection back if the caller stops early
+                try:
+                    pages.close()
+                except ValueError:
+                    # still running on a worker after a cancel; it closes itself
+                    pass
+        finally:
+            slots.release()
+
+    async def get(self, name, n=float("inf"), timeout=None):
+        return await self._run(self.db.get, name, n=n, timeout=timeout)
+
+    async def get_random(self, name, n: int, timeout=None, **kwargs):
+        return await self._run(self.db.get_random, name, n, timeout=timeout, **kwargs)
+
+    async def nrow(self, name, timeout=None):
+        return await self._run(self.db.nrow, name, timeout=timeout)
+
+    async def count(self, table, column, timeout=None, **kwargs):
+        return await self._run(self.db.count, table, column, timeout=timeout, **kwargs)
+
+    async def write_table(self, dataframe, name, timeout=None, **kwargs):
+        return await self._run(
+            self.db.write_table, dataframe, name, timeout=timeout, **kwargs
+        )
+
+    async def tables(self, to_list: bool = False, timeout=None):
+        return await self._run(self.db.tables, to_list=to_list, timeout=timeout)
+
+    async def columns(self, name: str = None, timeout=None):
+        return await self._run(self.db.columns, name, timeout=timeout)
+
+    async def lookup_schema_name(self, table, timeout=None):
+        return await self._run(self.db.lookup_schema_name, table, timeout=timeout)
+
+    async def search(self, term, timeout=None):
+        return await self._run(self.db.search, term, timeout=timeout)
+
+    async def variables(self, name=None, timeout=None):
+        return await self._run(self.db.variables, name, timeout=timeout)
+
+    async def describe(self, timeout=None):
+        return await self._run(self.db.describe, timeout=timeout)
+
+    async def database(self, timeout=None):
+        return await self._run(self.db.database, timeout=timeout)
+
+    async def server(self, timeout=None):
+        return await self._run(self.db.server, timeout=timeout)
+
+    def _connection_slots(self):
+        ## One slot per pooled connection.  Calls wait for a slot on the event
+        ## loop, not on a worker thread, so open iterators (which hold their
+        ## connection between pages) can't leave every worker blocked on the
+        ## pool while the iterators wait for a worker
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.db._pool.size)
+        return self._slots
+
+    async def _run(
+        self, function, *args, timeout=None, cursors=None, slot=True, **kwargs
+    ):
+
+        if slot:
+            slots = self._connection_slots()
+            await slots.acquire()
+            try:
+                return await self._run(
+                    function,
+                    *args,
+                    timeout=timeout,
+                    cursors=cursors,
+                    slot=False,
+                    **kwargs
+                )
+            finally:
+                slots.release()
+
+        if timeout is None:
+            timeout = self.timeout
+
+        ## The worker records every cursor it opens so they can be cancelled
+        if cursors is None:
+            cursors = []
+        call = functools.partial(
+            self.db._run_tracked, cursors, function, *args, **kwargs
+        )
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, call)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            ## Stop the statement on the server; the worker then errors out
+            ## and hands its connection back to the pool
+            for cursor in list(cursors):
+                try:
+                    cursor.cancel()
+                except Exception:
+                    pass
+            raise
@@ -1,23 +1,54 @@
+import base64
 import datetime
+import decimal
+import functools
+import hashlib
+import logging
 import os
+import queue
 import re
 import struct
 import sys
 import warnings
+from itertools import islice
 from math import floor, isinf
-from time import time
+from operator import itemgetter
+from time import perf_counter, time
 import subprocess
 import json
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
 import pyodbc
+from azure.core.credentials import AccessToken
 from azure.identity import AzureCliCredential
 from ds import clean
 from ds.paths import Paths
 from ds.utils import get_os, menu_input
 from requests import Session
 
+logger = logging.getLogger(__name__)
+
+
+## Open a span named after the method around each call
+def _spanned(name: str):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with self._profiler.span(name):
+                return function(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
 
 class ConnectDatabase:
 
@@ -29,20 +60,35 @@ class ConnectDatabase:
     Parameters:
         credentials: A named set of credentials (i.e., the named attribute from a config object) as read by ds.connect's Config class
         other: Additional semicolon separated elements to add to the end of the connection string; defaults to ';ApplicationIntent=ReadOnly'
-        token: A Boolean value, True (default) means that the Azure CLI will be utilized to generate a token (required for use on Mac).  If False, then multi-factor authentication is utilized.
+        token: A Boolean value, True (default) means that the Azure CLI will be utilized to generate a token (required for use on Mac).  If False, then multi-factor authentication is utilized.  Tokens are shared across processes through a private cache file in the user's home directory and are refreshed in the background before they expire.
         path: A path to a local Microsoft Access database (Windows only)
+        pool_size: The maximum number of connections (sessions) kept open and shared across queries and threads; defaults to 4
+        idle_timeout: Seconds a spare pooled connection may sit unused before it is closed; defaults to 600
+        catalog_ttl: Seconds that catalog metadata (tables, columns, schemas) is cached before it is queried again; defaults to 300 (use 0 to turn caching off)
+        cache_dir: The directory for query results saved with `query(..., cache = True)`; defaults to '.ds_query_cache' in the user's home directory
+        cache_ttl: Seconds a saved query result stays valid; defaults to 86400 (one day)
+        cache_size: The most bytes the saved query results may take on disk before the least recently used are removed; defaults to 2 GB
+        profile: If True, the connect, execute, and fetch seconds, rows, estimated bytes, and fingerprint of every statement (`query`, `iter_query`, and each `write_table` batch) are kept for `timings`; defaults to False.  Hooks added with `add_hook` and the 'ds.connect.database' logger (at DEBUG) get the same records either way
 
     Attributes:
         credentials: The credentials passed into the class saved for later
         connection_string: The connection string made for connecting
+        connection: A dedicated connection for direct pyodbc use, kept outside the pool and opened on first use
+        cursor: A cursor on `connection` (the same one on every access)
+        upload_stats: A DataFrame of the batches, rows, seconds, and rows per second each worker of the last `write_table` loaded
+        profile: True while the statement timings are kept (can be switched at any time)
+        upload_decisions: A DataFrame of each batch of the last `write_table(..., batch_size = 'auto')` (its rows, seconds, rows per second, and bytes per row) and the batch size chosen after it
 
     Methods:
-        as_create_sql_table: Convert a pandas DataFrame to tsql query (as a string) to add a table to a database
-        as_declare_sql_table: Convert a pandas DataFrame to tsql query (as a string) to use a table as an @ object within a sql query
+        add_hook: Register a function that is called with the timing record (a dict) of every statement and span; `remove_hook` unregisters it
+        as_create_sql_table: Convert a pandas DataFrame to tsql query (as a string) to add a table to a database.  Use `file = ` (a path or writable file-like object) to write the script a block at a time instead
+        as_declare_sql_table: Convert a pandas DataFrame to tsql query (as a string) to use a table as an @ object within a sql query.  Use `file = ` (a path or writable file-like object) to write the script a block at a time instead
         as_sql_list: Convert a Python list to a string for use in tsql
         check: A check to ensure the connection is still good
+        clear_query_cache: Remove the saved result of `query` (or all of this database's saved results if `query = None`)
+        clear_timings: Drop the kept statement timings
         close: Close the established connection
-        count: A method to generate aggregated counts (including NULLS) of an enumerated column.  To create, supply the args `name` (table name as a string) and `column` (enumerated field as a string)
+        count: A method to generate aggregated counts (including NULLS) of an enumerated column.  To create, supply the args `name` (table name as a string) and `column` (enumerated field as a string).  Values used in `where` can be bound with `?` placeholders and `params`
         database: A method to report the database that is connected
         delete_table: A method to delete tables from a data base, simply supply `name` as a string for the table name
         describe: A method to give the sizes of the tables in a database
@@ -50,15 +96,21 @@ class ConnectDatabase:
         get: A method to extract tables from the database.  Use the argument `n = ` to get the top n rows
         nrow: Get the number of rows for a table
         columns: get the names of columns for a table as a list (if `name = None` then all tables and columns are returned as a table)
-        get_random: Get n random rows for a table
+        get_random: Get n random rows for a table.  `method = 'rows'` (default) returns exactly n rows drawn by row number; 'newid' (a single scan that keeps each row with a NEWID() hash probability) and 'tablesample' (page level TABLESAMPLE) are faster approximate samples for large tables
         is_open: A method to report if the connection is closed
+        iter_query: A method to stream the results of a sql query as a generator of DataFrames of (at most) `chunksize` rows
+        iter_sql_table: A generator version of as_declare_sql_table/as_create_sql_table (pass `command`/`command2`) that yields the declaration and then the insert statements for `block_rows` rows at a time
         lookup_schema_name: A function to return the schema name given the table name
-        query: A method to query the data base directly with sql code
+        query_many: Run a list of independent queries concurrently (one pooled connection per worker, capped at `pool_size`) and return the results in input order; a failed query's slot holds its exception.  Results are fetched whole (`chunksize` and `results = False` are not allowed)
+        refresh_catalog: Drop the cached catalog metadata so the next metadata call goes to the server
+        query: A method to query the data base directly with sql code.  Use `params = ` to bind values to `?` placeholders (repeated parameterized statements reuse their prepared plan on each connection).  Use `chunksize = ` to return a generator of DataFrames rather than one DataFrame and `engine = 'columnar'` to build typed columns straight from the cursor instead of using pandas' type inference.  Use `cache = True` to save the result on disk and reuse it while it is fresh
         search: A method to list all the tables and column names that contain a search term.  Use the argument `term = ` to specify the search term
         server: A method to report the server to which the database is located
+        span: A context manager that groups the statements run inside it under a name (spans nest); each span is recorded too, with its total seconds
+        timings: A DataFrame of the kept statement and span timings (with `profile = True`); `fingerprint` is the hash of the normalized sql, so repeats of a statement can be grouped
         tables: A method to list valid (1) base and (2) view tables that can be queried via `.get()`
         variables: A method to give the of all tables in the data base database or a specific table if `name` is not missing
-        write_table: A method to add, append, or overwrite tables.  To create, supply the args `dataframe` (Pandas DataFrame) and `name` (table name as a string).  One can also use `append = True` and overwrite = `True`
+        write_table: A method to add, append, merge, or incrementally load a table from a DataFrame, iterator of pages, or CSV/Parquet file (see `help(ConnectDatabase.write_table)` for its arguments)
 
     Examples::
 
@@ -109,6 +161,26 @@ class ConnectDatabase:
 
         fakes = idb.query(my_query)
         fakes
+
+        ## Bind values rather than formatting them into the sql
+        idb.query('SELECT * FROM [dbo].[Institution] WHERE [State] = ? AND Deleted = ?', params = ['IA', 0])
+
+        ## Save the pull on disk; re-running it within `cache_ttl` skips the server
+        fakes = idb.query(my_query, cache = True)
+        idb.clear_query_cache(my_query)
+
+        ## Run independent pulls concurrently
+        inst, files = idb.query_many([my_query, 'SELECT TOP 10 * FROM [dbo].[Institution]'])
+
+        ## Find where the time goes
+        idb.profile = True
+        with idb.span('institution pull'):
+            fakes = idb.query(my_query)
+        idb.timings().groupby('fingerprint')['seconds'].sum()
+
+        ## Stream large results in pages
+        for chunk in idb.query('SELECT * FROM [dbo].[Institution]', chunksize = 50000):
+            print(chunk.shape)
     """
 
     def __init__(
@@ -117,8 +189,28 @@ class ConnectDatabase:
         other: str = ";ApplicationIntent=ReadOnly",
         token: bool = True,
         path: str = None,
+        pool_size: int = 4,
+        idle_timeout: int = 600,
+        catalog_ttl: int = 300,
+        cache_dir: str = None,
+        cache_ttl: int = 86400,
+        cache_size: int = 2 * 1024**3,
+        profile: bool = False,
     ):
 
+        if (not isinstance(pool_size, int)) or (pool_size < 1):
+            raise Exception("`pool_size` must be a positive integer")
+
+        self._token_lock = threading.Lock()
+        self._local = threading.local()
+        self._direct_lock = threading.Lock()
+        self._direct, self._direct_cursor = None, None
+        self._catalog = _CatalogCache(ttl=catalog_ttl)
+        self._query_cache = _QueryCache(
+            directory=cache_dir, ttl=cache_ttl, max_bytes=cache_size
+        )
+        self._profiler = _Profiler(enabled=profile)
+
         if credentials is not None:
             self.credentials = credentials
             expected = [
@@ -169,10 +261,11 @@ class ConnectDatabase:
 
                     print("Using Stored Credentials & Obtaining Token", flush=True)
 
-                    self.token = _DataBaseCredentialWrapper(
+                    self._token_manager = _get_token_manager(
                         tenant=self.tenant, tenantid=self.credentials.get("TenantId")
                     )
-                    tokenstruct = _prepare_token(self.token)
+                    self.token = self._token_manager.token
+                    self._tokenstruct = _prepare_token(self.token)
 
                     # build connection string using acquired token
                     self.connection_string = _Hidden_Password_String(
@@ -183,12 +276,6 @@ class ConnectDatabase:
                         )
                         + other
                     )
-
-                    SQL_COPT_SS_ACCESS_TOKEN = 1256
-                    self.connection = pyodbc.connect(
-                        self.connection_string,
-                        attrs_before={SQL_COPT_SS_ACCESS_TOKEN: tokenstruct},
-                    )
                     self.connection_type = "Token"
                     self.other = other
 
@@ -229,13 +316,8 @@ class ConnectDatabase:
                         )
                         + other
                     )
-
-                    self.connection = pyodbc.connect(self.connection_string)
                     self.connection_type = "MFA"
 
-                # self.connection.timeout = 0
-                self.cursor = self.connection.cursor()
-
         elif (path is not None) and (get_os() == "Windows"):
 
             self.credentials = {"Path": path, "SourceType": "Local Database"}
@@ -248,13 +330,24 @@ class ConnectDatabase:
                     self.path
                 )
             )
-            self.connection = pyodbc.connect(self.connection_string)
             self.connection_type = "Local Database"
-            self.cursor = self.connection.cursor()
 
         else:
             raise Exception("No `credentials` or `path` (Windows only) supplied")
 
+        self._pool = _ConnectionPool(
+            self._new_connection,
+            size=pool_size,
+            idle_timeout=idle_timeout,
+            ping=None if self.connection_type == "Local Database" else _ping,
+        )
+
+        ## Open the first connection now so bad credentials fail here
+        self._pool.release(self._pool.acquire())
+
+        if self.connection_type == "Token":
+            self._token_manager.subscribe(self._on_token_refresh)
+
     def __repr__(self):
         return "\n" + "\n".join(
             [
@@ -263,70 +356,320 @@ class ConnectDatabase:
             ]
         )
 
+    ## A dedicated connection and cursor for direct pyodbc use, outside the
+    ## pool (pyodbc connections can't be shared across threads, and the pool
+    ## lends its connections to `query_many` and upload workers)
+    @property
+    def connection(self):
+        with self._direct_lock:
+            if self._direct is None:
+                self._direct = self._new_connection()
+            return self._direct
+
+    @property
+    def cursor(self):
+        connection = self.connection
+        with self._direct_lock:
+            if self._direct_cursor is None:
+                self._direct_cursor = connection.cursor()
+            return self._direct_cursor
+
+    @property
+    def profile(self):
+        return self._profiler.enabled
+
+    @profile.setter
+    def profile(self, value: bool):
+        self._profiler.enabled = bool(value)
+
+    def _new_connection(self):
+        if self.connection_type == "Token":
+            return pyodbc.connect(
+                self.connection_string,
+                attrs_before={SQL_COPT_SS_ACCESS_TOKEN: self._tokenstruct},
+            )
+        else:
+            return pyodbc.connect(self.connection_string)
+
+    def _new_cursor(self, connection):
+        return self._track(connection.cursor())
+
+    def _track(self, cursor):
+        ## Let a caller on this thread (e.g., AsyncConnectDatabase) cancel it
+        tracked = getattr(self._local, "cursors", None)
+        if tracked is not None:
+            tracked.append(cursor)
+
+        return cursor
+
+    def _run_tracked(self, cursors: list, function, *args, **kwargs):
+        self._local.cursors = cursors
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._local.cursors = None
+
     def test_token(self):
 
-        if (self.connection_type == "Token") and (
-            time() > self.token.cli_token.expires_on - 100
-        ):
+        if self.connection_type != "Token":
+            return
+
+        ## Normally the background refresh has already swapped the token in
+        if time() > self.token.cli_token.expires_on - 100:
 
             print(
                 "Getting new Access Token\nUsing Stored Credentials & Obtaining Token",
                 flush=True,
             )
 
-            self.token = _DataBaseCredentialWrapper(
-                tenant=self.tenant, tenantid=self.credentials.get("TenantId")
-            )
-            tokenstruct = _prepare_token(self.token)
+            self._on_token_refresh(self._token_manager.get())
 
-            SQL_COPT_SS_ACCESS_TOKEN = 1256
-            self.connection = pyodbc.connect(
-                self.connection_string,
-                attrs_before={SQL_COPT_SS_ACCESS_TOKEN: tokenstruct},
-            )
+    def _on_token_refresh(self, token):
+
+        with self._token_lock:
+            if token.cli_token.token == self.token.cli_token.token:
+                return
+            self.token = token
+            self._tokenstruct = _prepare_token(token)
+
+        ## Connections made with the old token are closed as they come back
+        self._pool.refresh()
 
     def check(self):
         self.test_token()
         try:
-            cursor = self.connection.cursor()
+            with self._pool.connection():
+                pass
             # print("Connection Appears Open", flush=True)
         except Exception as e:
-            if e.__class__ == pyodbc.ProgrammingError:
-                warnings.warn("Connection Has Been Closed")
+            warnings.warn("Connection Has Been Closed")
 
     def close(self):
-        self.test_token()
-        self.cursor.close()
-        self.connection.close()
-        try:
-            cursor = self.connection.cursor()
-        except Exception as e:
-            cursor = None
-        else:
-            warnings.warn("Connection seems to be open still")
+        with self._direct_lock:
+            if self._direct_cursor is not None:
+                _close_quietly(self._direct_cursor)
+            if self._direct is not None:
+                _close_quietly(self._direct)
+            self._direct, self._direct_cursor = None, None
+        self._pool.close()
 
     ##def timeout(self, timeout:int = 0):
     ##
     ##    self.connection.timeout = timeout
     ##    self.cursor = self.connection.cursor()
 
-    def query(self, query=None, results=True):
+    def query(
+        self,
+        query=None,
+        results=True,
+        chunksize: int = None,
+        engine: str = "pandas",
+        cache: bool = False,
+        params: list = None,
+    ):
+
+        _check_engine(engine)
 
-        self.check()
+        self.test_token()
 
         if query is None:
             query = "SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE IN ('BASE TABLE', 'VIEW') AND TABLE_SCHEMA NOT IN ('sys')"
 
-        if results is True:
-            # print("Returning Results", flush=True)
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                dat = pd.read_sql_query(query, self.connection)
-            return dat
+        if cache:
+            if (results is not True) or (chunksize is not None):
+                raise Exception(
+                    "`cache = True` can not be used with `results = False` or `chunksize`"
+                )
+
+            key = self._query_cache.key(query, engine, params)
+            found = self._query_cache.get(self._cache_namespace(), key)
+            if found is not None:
+                return found
+
+            out = self.query(query, engine=engine, params=params)
+            self._query_cache.put(self._cache_namespace(), key, out)
+            return out
+
+        if (chunksize is not None) and (results is True):
+            return self.iter_query(
+                query, chunksize=chunksize, engine=engine, params=params
+            )
+
+        timing = _Timing(self._profiler, "query", query)
+        out = None
+
+        with self._pool.checkout() as entry:
+            connection = entry.connection
+            timing.mark("connect")
+
+            ## Parameterized statements are the ones that get repeated; keep
+            ## their cursors (and so their prepared plans) on the connection
+            if params is None:
+                cursor = self._new_cursor(connection)
+            else:
+                cursor = self._track(entry.statements.cursor(connection, query))
+
+            try:
+                _execute(cursor, query, params)
+                if results is not True:
+                    # print("No results returned", flush=True)
+                    connection.commit()
+                    timing.mark("execute")
+                    timing.rows = cursor.rowcount if cursor.rowcount >= 0 else None
+                    ## The statement may have been DDL
+                    self._catalog.invalidate()
+                elif engine == "columnar":
+                    timing.mark("execute")
+                    out = _fetch_columnar(cursor)
+                    timing.mark("fetch")
+                else:
+                    # print("Returning Results", flush=True)
+                    timing.mark("execute")
+                    columns = [x[0] for x in cursor.description]
+                    out = _rows_to_frame(cursor.fetchall(), columns)
+                    timing.mark("fetch")
+            except BaseException as e:
+                timing.error = e
+                if params is not None:
+                    entry.statements.discard(query)
+                raise
+            finally:
+                if params is None:
+                    cursor.close()
+                timing.finish(out)
+
+        return out
+
+    def clear_query_cache(self, query=None, engine: str = "pandas", params=None):
+        if query is None:
+            self._query_cache.clear(self._cache_namespace())
         else:
-            # print("No results returned", flush=True)
-            self.connection.cursor().execute(query)
-            self.connection.commit()
+            self._query_cache.clear(
+                self._cache_namespace(), self._query_cache.key(query, engine, params)
+            )
+
+    def add_hook(self, callback):
+        self._profiler.hooks.append(callback)
+
+    def remove_hook(self, callback):
+        if callback in self._profiler.hooks:
+            self._profiler.hooks.remove(callback)
+
+    def span(self, name: str):
+        return self._profiler.span(name)
+
+    def timings(self):
+        return self._profiler.frame()
+
+    def clear_timings(self):
+        self._profiler.clear()
+
+    def _cache_namespace(self):
+        ## Results are kept apart per server and database
+        return _hash_text(
+            "|".join(
+                [
+                    str(self.credentials.get("ServerName", "")),
+                    str(self.credentials.get("Database", "")),
+                    str(self.credentials.get("Path", "")),
+                ]
+            )
+        )[:16]
+
+    def query_many(
+        self, queries: list, max_workers: int = None, errors: str = "warn", **kwargs
+    ):
+
+        if errors not in ["warn", "raise", "ignore"]:
+            raise Exception("`errors` must be one of 'warn', 'raise', or 'ignore'")
+
+        ## Every result is fetched on its worker; a generator (`chunksize`)
+        ## would hold its pooled connection until consumed and starve the
+        ## other workers
+        if (
+            kwargs.get("chunksize") is not None
+            or kwargs.get("results", True) is not True
+        ):
+            raise Exception(
+                "`query_many` can not be used with `chunksize` or `results = False`"
+            )
+
+        queries = list(queries)
+        if len(queries) == 0:
+            return []
+
+        ## Never ask for more sessions than the pool allows
+        if max_workers is None:
+            max_workers = self._pool.size
+        max_workers = max(1, min(max_workers, self._pool.size, len(queries)))
+
+        self.test_token()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.query, x, **kwargs) for x in queries]
+
+        out = []
+        for i, future in enumerate(futures):
+            error = future.exception()
+            if error is None:
+                out.append(future.result())
+                continue
+
+            if errors == "raise":
+                raise error
+            elif errors == "warn":
+                warnings.warn(
+                    "Query {} of {} failed: {}".format(i + 1, len(queries), error)
+                )
+            out.append(error)
+
+        return out
+
+    def iter_query(
+        self,
+        query,
+        chunksize: int = 100000,
+        engine: str = "pandas",
+        params: list = None,
+    ):
+
+        if (not isinstance(chunksize, int)) or (chunksize < 1):
+            raise Exception("`chunksize` must be a positive integer")
+
+        _check_engine(engine)
+
+        self.test_token()
+
+        timing = _Timing(self._profiler, "iter_query", query)
+
+        ## The connection stays checked out until the pages are exhausted
+        entry = self._pool.acquire()
+        timing.mark("connect")
+        try:
+            cursor = self._new_cursor(entry.connection)
+            cursor.arraysize = chunksize
+            _execute(cursor, query, params)
+            timing.mark("execute")
+            if cursor.description is None:
+                cursor.close()
+                raise Exception("`query` did not return a result set to iterate over")
+        except Exception as e:
+            timing.error = e
+            timing.finish()
+            self._pool.release(entry, failed=True)
+            raise
+
+        pages = _fetch_pages(
+            cursor,
+            chunksize=chunksize,
+            engine=engine,
+            release=lambda: self._pool.release(entry),
+        )
+        if timing.profiler is not None:
+            pages = _timed_pages(pages, timing)
+
+        ## Start the generator so its cleanup runs even if it is never consumed
+        return _prepend(next(pages), pages)
 
     def is_open(self):
         try:
@@ -346,24 +689,53 @@ class ConnectDatabase:
         )
 
     def get(self, name, n=float("inf")):
-        return self.query(
-            "SELECT {} * FROM {} WITH (NOLOCK)".format(
-                "" if isinf(n) else "TOP ({}) ".format(n), name
+        if isinf(n):
+            return self.query("SELECT * FROM {} WITH (NOLOCK)".format(name))
+        else:
+            return self.query(
+                "SELECT TOP (?) * FROM {} WITH (NOLOCK)".format(name), params=[int(n)]
             )
-        )
 
     def nrow(self, name):
         return self.query(
-            "SELECT sum([rows]) FROM sys.partitions WHERE object_id=object_id('{}') AND index_id in (0,1)".format(
-                name
-            )
+            "SELECT sum([rows]) FROM sys.partitions WHERE object_id=object_id(?) AND index_id in (0,1)",
+            params=[name],
         )
 
+    def _row_count(self, name, metadata: bool = False):
+        ## The partition stats are read from metadata, not by scanning the table
+        if metadata:
+            out = self.query(
+                "SELECT sum([row_count]) FROM sys.dm_db_partition_stats WHERE object_id=object_id(?) AND index_id in (0,1)",
+                params=[name],
+            ).iloc[0, 0]
+        else:
+            out = self.query("SELECT COUNT(*) as n FROM {}".format(name)).iloc[0, 0]
+
+        return 0 if pd.isnull(out) else int(out)
+
     def columns(self, name: str = None):
 
         if name is None:
-            return self.query(
-                """
+            return self._catalog.get("sys.columns", self._sys_columns).copy()
+        else:
+            found = self._information_schema_columns()
+            found = found[found["TABLE_NAME"] == name].sort_values("ORDINAL_POSITION")
+            if found["TABLE_SCHEMA"].nunique() == 1:
+                return found["COLUMN_NAME"].to_list()
+
+            ## Not in the catalog (e.g., a synonym) or in more than one
+            ## schema; ask the object the name resolves to
+            return self._catalog.get(
+                ("columns", name),
+                lambda: list(
+                    self.query("SELECT TOP 0 * FROM [{}]".format(name)).columns
+                ),
+            )
+
+    def _sys_columns(self):
+        return self.query(
+            """
             SELECT schema_name(tab.schema_id) as schema_name,
                 tab.name as table_name, 
                     col.column_id,
@@ -380,11 +752,13 @@ class ConnectDatabase:
                     table_name, 
                     column_id;
             """
-            )
-        else:
-            return list(self.query("SELECT TOP 0 * FROM [{}]".format(name)).columns)
+        )
+
+    def get_random(self, name, n: int, method: str = "rows", seed: int = None):
+
+        if method not in ["rows", "newid", "tablesample"]:
+            raise Exception("`method` must be one of 'rows', 'newid', or 'tablesample'")
 
-    def get_random(self, name, n: int):
         nr = self.nrow(name).iloc[0, 0]
         if n > nr:
             raise Exception(
@@ -393,60 +767,137 @@ class ConnectDatabase:
                 )
             )
 
-        colnm = self.columns(name)[0]
+        if method == "rows":
+            return self._get_random_rows(name, n, nr, seed=seed)
+
+        ## The approximate samplers keep a bit more than n / nr of the table and
+        ## take a random n of those; widen the net if too few came back
+        if method == "newid":
+            sample_query = " ".join(
+                [
+                    "SELECT TOP (?) * FROM {} WITH (NOLOCK)",
+                    "WHERE ABS(CAST(CHECKSUM(NEWID()) AS BIGINT)) % 1000000 < ?",
+                    "ORDER BY NEWID()",
+                ]
+            )
+        else:
+            sample_query = " ".join(
+                [
+                    "SELECT TOP (?) * FROM {} TABLESAMPLE SYSTEM ({} PERCENT)",
+                    "ORDER BY NEWID()",
+                ]
+            )
+
+        fraction = min(1.0, 1.25 * n / nr)
+        while True:
+            if method == "newid":
+                out = self.query(
+                    sample_query.format(name),
+                    params=[int(n), int(np.ceil(fraction * 1000000))],
+                )
+            else:
+                out = self.query(
+                    sample_query.format(name, repr(float(100 * fraction))),
+                    params=[int(n)],
+                )
 
-        rows = self._random_rows_as_sql_list(n, nr)
+            if (out.shape[0] >= n) or (fraction >= 1):
+                break
+            fraction = min(1.0, fraction * 2)
 
-        return self.query(
-            "WITH myTableWithRows AS (SELECT (ROW_NUMBER() OVER (ORDER BY [{}])) as RowNumber,* FROM {} ) SELECT * FROM myTableWithRows WHERE RowNumber IN {}".format(
-                colnm, name, rows
+        if out.shape[0] < n:
+            warnings.warn(
+                "Only {} of the {} requested rows were sampled from '{}'".format(
+                    out.shape[0], n, name
+                )
             )
-        )
 
-    def _random_rows_as_sql_list(self, n, size):
+        return out
+
+    def _get_random_rows(self, name, n: int, nr: int, seed: int = None):
+
+        colnm = self.columns(name)[0]
+        rows = _sample_rows(n, nr, seed=seed)
 
-        rows = []
-        while len(rows) < n:
-            val = np.random.randint(1, size + 1)
-            if val not in rows:
-                rows.append(val)
+        ## Join against a temp table of row numbers rather than an IN (...) list
+        sample_query = " ".join(
+            [
+                "WITH myTableWithRows AS (SELECT (ROW_NUMBER() OVER (ORDER BY [{}])) as RowNumber,* FROM {} )",
+                "SELECT t.* FROM myTableWithRows AS t",
+                "INNER JOIN #ds_sample_rows AS r ON t.RowNumber = r.RowNumber",
+                "ORDER BY t.RowNumber",
+            ]
+        ).format(colnm, name)
 
-        return self.as_sql_list(np.sort(rows))
+        with self._pool.connection() as connection:
+            cursor = self._new_cursor(connection)
+            try:
+                cursor.execute(
+                    "CREATE TABLE #ds_sample_rows (RowNumber BIGINT PRIMARY KEY)"
+                )
+                cursor.fast_executemany = True
+                cursor.executemany(
+                    "INSERT INTO #ds_sample_rows (RowNumber) VALUES (?)",
+                    [(x,) for x in rows.tolist()],
+                )
+                cursor.execute(sample_query)
+                columns = [x[0] for x in cursor.description]
+                return _rows_to_frame(cursor.fetchall(), columns)
+            finally:
+                ## Rolling back also drops the temp table before the
+                ## connection goes back to the pool
+                connection.rollback()
+                cursor.close()
 
     def tables(self, to_list: bool = False):
+        out = self._catalog.get(
+            "information_schema.tables",
+            lambda: self.query("SELECT * FROM information_schema.tables;"),
+        )
         if to_list:
-            return self.query("SELECT * FROM information_schema.tables;")[
-                "TABLE_NAME"
-            ].to_list()
+            return out["TABLE_NAME"].to_list()
         else:
-            return self.query("SELECT * FROM information_schema.tables;")
+            return out.copy()
+
+    def refresh_catalog(self):
+        self._catalog.invalidate()
+
+    def _information_schema_columns(self):
+        return self._catalog.get(
+            "information_schema.columns",
+            lambda: self.query("select * from information_schema.columns"),
+        )
 
     def list_tables(self):
         if self.connection_type == "Local Database":
-            return [row.table_name for row in self.cursor.tables()]
+            with self._pool.connection() as connection:
+                cursor = self._new_cursor(connection)
+                return [row.table_name for row in cursor.tables()]
         else:
             return list(self.tables()["TABLE_NAME"])
 
     def lookup_schema_name(self, table):
-        return (
-            self.tables()[["TABLE_SCHEMA", "TABLE_NAME"]]
+        return self._catalog.get(
+            "schemas",
+            lambda: self.tables()[["TABLE_SCHEMA", "TABLE_NAME"]]
             .set_index("TABLE_NAME", inplace=False)
-            .to_dict()["TABLE_SCHEMA"][table]
-        )
+            .to_dict()["TABLE_SCHEMA"],
+        )[table]
 
     def search(self, term):
 
-        search_query = " ".join(
-            [
-                "SELECT COLUMN_NAME, TABLE_NAME, TABLE_SCHEMA",
-                "FROM INFORMATION_SCHEMA.COLUMNS",
-                "WHERE COLUMN_NAME LIKE '%" + term + "%' ",
-            ]
-        )
+        ## Same matching as `COLUMN_NAME LIKE '%term%'` but against the cached catalog
+        found = self._information_schema_columns()
+        found = found.loc[
+            found["COLUMN_NAME"].str.contains(
+                _like_to_regex(term), case=False, regex=True, na=False
+            ),
+            ["COLUMN_NAME", "TABLE_NAME", "TABLE_SCHEMA"],
+        ]
 
-        return self.query(search_query)
+        return found.reset_index(drop=True)
 
-    def count(self, table, column, decreasing=True, where=None):
+    def count(self, table, column, decreasing=True, where=None, params=None):
 
         if decreasing:
             order = "desc"
@@ -493,7 +944,10 @@ class ConnectDatabase:
             order,
         )
 
-        return self.query(count_query)
+        ## `where` appears in both halves of the union
+        return self.query(
+            count_query, params=None if params is None else list(params) * 2
+        )
 
     def as_sql_list(self, x: list):
         return (
@@ -511,9 +965,13 @@ class ConnectDatabase:
         command2: str = "TABLE",
         additional: str = "",
         nullable: list = [True],
+        file=None,
+        types: str = "legacy",
+        dtypes: dict = None,
     ):
 
-        out = _make_sql_table_query(
+        return _write_sql_table_query(
+            file,
             dataframe,
             name=name,
             break_length=break_length,
@@ -521,10 +979,10 @@ class ConnectDatabase:
             command2=command2,
             additional=additional,
             nullable=nullable,
+            types=types,
+            dtypes=dtypes,
         )
 
-        return out
-
     def as_create_sql_table(
         self,
         dataframe,
@@ -534,9 +992,13 @@ class ConnectDatabase:
         command2: str = "",
         additional: str = "",
         nullable: list = [True],
+        file=None,
+        types: str = "legacy",
+        dtypes: dict = None,
     ):
 
-        out = _make_sql_table_query(
+        return _write_sql_table_query(
+            file,
             dataframe,
             name=name,
             break_length=break_length,
@@ -544,9 +1006,36 @@ class ConnectDatabase:
             command2=command2,
             additional=additional,
             nullable=nullable,
+            types=types,
+            dtypes=dtypes,
         )
 
-        return out
+    def iter_sql_table(
+        self,
+        dataframe,
+        name: str = "@mytable",
+        break_length: int = 1000,
+        command: str = "DECLARE",
+        command2: str = "TABLE",
+        additional: str = "",
+        nullable: list = [True],
+        block_rows: int = 100000,
+        types: str = "legacy",
+        dtypes: dict = None,
+    ):
+
+        return _iter_sql_table_query(
+            dataframe,
+            name=name,
+            break_length=break_length,
+            command=command,
+            command2=command2,
+            additional=additional,
+            nullable=nullable,
+            block_rows=block_rows,
+            types=types,
+            dtypes=dtypes,
+        )
 
     def fake_institutions(self, as_sql_list: bool = True):
         return clean.fake_institutions(as_sql_list=as_sql_list)
@@ -555,7 +1044,8 @@ class ConnectDatabase:
 
         if not self._has_permission(operation="DROP TABLE"):
             return
-        elif name not in self.tables(to_list=True):
+
+        if name not in self.tables(to_list=True):
             warnings.warn("`{}` does appear to be in the database?".format(name))
 
             ans = menu_input(
@@ -566,24 +1056,42 @@ class ConnectDatabase:
             )
             if ans == "No":
                 raise Exception("Aborting table deletion")
-            else:
-                tabs = self.tables()
-                query = "DROP TABLE [{}].[{}].[{}];".format(
-                    self.database().iloc[0, 0], self.lookup_schema_name(name), name
-                )
-                cursor = self.connection.cursor()
-                cursor.execute(query)
-                cursor.commit()
 
-            if name in self.tables(to_list=True):
-                warnings.warn("`{}` does not appear to have deleted!".format(name))
+        query = "DROP TABLE [{}].[{}].[{}];".format(
+            self._catalog.get("database", lambda: self.database().iloc[0, 0]),
+            self.lookup_schema_name(name),
+            name,
+        )
+        with self._pool.connection() as connection:
+            self._new_cursor(connection).execute(query)
+            connection.commit()
+
+        self._catalog.invalidate()
+
+        if name in self.tables(to_list=True):
+            warnings.warn("`{}` does not appear to have deleted!".format(name))
+
+    def write_schema(
+        self,
+        dataframe,
+        name,
+        overwrite: bool = False,
+        types: str = "legacy",
+        dtypes: dict = None,
+        columnstore: bool = False,
+        compression: str = None,
+        clustered: list = None,
+        indexes: list = None,
+    ):
 
-    def write_schema(self, dataframe, name, overwrite: bool = False):
+        design = _make_sql_design_queries(
+            name, columnstore, compression, clustered, indexes
+        )
 
         self.test_token()
         found = name in self.tables(to_list=True)
 
-        if re.search(" ", dataframe.columns):
+        if any([" " in str(x) for x in dataframe.columns]):
             raise Exception(
                 "Aborting write because `{}` contained a column header with a space".format(
                     name
@@ -599,8 +1107,6 @@ class ConnectDatabase:
                     )
                 )
 
-        cursor = self.connection.cursor()
-
         write_query = _make_sql_schema_query(
             dataframe=dataframe,
             name=name,
@@ -608,14 +1114,53 @@ class ConnectDatabase:
             command2="",
             additional="",
             nullable=[True],
+            types=types,
+            dtypes=dtypes,
         )
 
-        self.connection.cursor().execute(write_query)
-        self.connection.commit()
+        with self._pool.connection() as connection:
+            self._new_cursor(connection).execute(write_query)
+            connection.commit()
+
+        self._catalog.invalidate()
 
         if name not in self.tables(to_list=True):
             warnings.warn("`{}` does not appear to have written!".format(name))
 
+        self._build_design(name, design)
+
+    def _build_design(self, name, design: list, verbose: bool = False):
+
+        if len(design) == 0:
+            return
+
+        if verbose:
+            start = datetime.datetime.now()
+            print(
+                "\n"
+                + "Building the storage and indexes of `{}` at {}".format(
+                    name, start.strftime("%I:%M:%S %p")
+                )
+            )
+            sys.stdout.flush()
+
+        with self._pool.connection() as connection:
+            cursor = self._new_cursor(connection)
+            for query in design:
+                cursor.execute(query)
+            connection.commit()
+
+        self._catalog.invalidate()
+
+        if verbose:
+            print(
+                "    Built in {} minutes".format(
+                    round((datetime.datetime.now() - start).total_seconds() / 60, 1)
+                )
+            )
+            sys.stdout.flush()
+
+    @_spanned("write_table")
     def write_table(
         self,
         dataframe,
@@ -625,40 +1170,308 @@ class ConnectDatabase:
         break_length: int = 1000,
         batch_size: int = 200000,
         verbose: bool = True,
+        method="executemany",
+        verify: str = "rowcount",
+        parallel: int = 1,
+        resume=False,
+        columns: list = None,
+        types: str = "legacy",
+        dtypes: dict = None,
+        mode: str = None,
+        keys: list = None,
+        delete_missing: bool = False,
+        watermark: str = None,
+        columnstore: bool = False,
+        compression: str = None,
+        clustered: list = None,
+        indexes: list = None,
     ):
+        """Add, append, or overwrite a table
+
+        The rows are loaded in batches; the next batch is staged on a background
+        thread while the current one loads.
+
+        Parameters:
+            dataframe: The rows to write: a pandas DataFrame, an iterator of DataFrames, an iterator of tuples (named with `columns`), or the path to a CSV or Parquet file.  Non-DataFrame sources are streamed in pages of `batch_size` rows and the table's types come from the first page
+            name: The table name as a string
+            overwrite: If True, an existing table `name` is deleted and remade
+            append: If True, the rows are added to the existing table `name`
+            break_length: Kept for compatibility; unused by the batch loaders
+            batch_size: The rows per batch; defaults to 200000.  'auto' starts small, doubles while the rows per second hold up, then grows a step at a time, and halves when a batch runs slow or the throughput drops (batches stay under 64 MB); each decision is printed (with `verbose = True`) and kept in `upload_decisions`
+            verbose: If True (default), the progress of each batch is printed
+            method: The loader: 'executemany' (default), 'bulk' (a staged file and BULK INSERT), or an UploadBackend such as BulkInsertBackend(...) or LocalEngineBackend(...)
+            verify: How the row counts are checked: 'rowcount' (default; the counts the driver reports, or one COUNT(*) at the end when it reports none), 'count' (one COUNT(*) at the end), 'metadata' (sys.dm_db_partition_stats at the end), 'batch' (a COUNT(*) after every batch; one worker only), or 'none'
+            parallel: The number of pooled connections that load disjoint batches at once; defaults to 1 (per worker throughput is kept in `upload_stats`)
+            resume: If True, the committed batches are journaled and rerunning the same call after a failure continues from the first batch that did not commit.  Iterator sources need a key naming the data (e.g., `resume = '2024-01-02'`) since their rows can not be fingerprinted
+            columns: The column names of an iterator of tuples
+            types: 'legacy' (default) or 'narrow' (the narrowest column types the data allows: TINYINT through BIGINT, exact DECIMAL precision, DATE/DATETIME2, and tight VARCHAR/NVARCHAR lengths).  Streamed sources need every column pinned in `dtypes` to use 'narrow'
+            dtypes: A dictionary of `{'column': 'sql type'}` that sets the type of individual columns
+            mode: None (default), 'merge', or 'incremental'
+            keys: With `mode = 'merge'`, the columns that identify a row; the rows are loaded into a staging table and MERGEd into `name` in one statement (matching rows are updated and new rows inserted)
+            delete_missing: With `mode = 'merge'`, if True the table's rows that are not in `dataframe` are deleted
+            watermark: With `mode = 'incremental'`, a monotonic column (e.g., a timestamp or identity); only the rows past the table's maximum of it are appended.  The maximum is looked up once and then recorded in `~/.ds_upload_journal/watermarks.json` (delete its entry if something else writes to the table)
+            columnstore: If True, a table this call creates gets a clustered columnstore index (built after the rows are loaded, as is the rest of the design)
+            compression: 'page' or 'row' compression for a table this call creates
+            clustered: The columns of a clustered index for a table this call creates
+            indexes: A list of nonclustered indexes (each a column or list of columns) for a table this call creates
+
+        Examples::
+
+            from ds.connect import ConnectDatabase, Config, LocalEngineBackend
+            import sqlite3
+            import pandas as pd
+
+            pdb = ConnectDatabase(Config().publicdata)
+            iris = pd.read_csv('https://raw.githubusercontent.com/mwaskom/seaborn-data/master/iris.csv')
+
+            pdb.write_table(iris, 'DeleteMeIris', overwrite = True, types = 'narrow')
+            pdb.write_table(iris, 'DeleteMeIris', append = True, batch_size = 'auto', parallel = 2)
+            pdb.write_table('iris.csv', 'DeleteMeIris', append = True, resume = True)
+            pdb.write_table(iris, 'DeleteMeIris', mode = 'merge', keys = ['species'])
+
+            ## Offline, into a local SQLite database
+            pdb.write_table(iris, 'iris', method = LocalEngineBackend(sqlite3.connect('iris.db')))
+        """
+
+        backend = _upload_backend(method)
+
+        ## `batch_size = 'auto'` hands the page size to a control loop fed by
+        ## each committed batch
+        sizer = None
+        if batch_size == "auto":
+            if resume:
+                raise Exception("`resume = True` needs a fixed `batch_size`")
+            sizer = _BatchSizer()
+            batch_size = sizer
+
+        ## Built once the rows are in (loading a heap and then indexing it
+        ## is much faster than maintaining the indexes batch by batch)
+        design = _make_sql_design_queries(
+            name, columnstore, compression, clustered, indexes
+        )
+        if len(design) > 0 and not backend.remote:
+            raise Exception(
+                "`columnstore`, `compression`, `clustered`, and `indexes` need a server `method`"
+            )
 
-        if verbose:
-            jobstart = datetime.datetime.now()
-            print("Upload Start: {}".format(jobstart.strftime("%I:%M:%S %p")))
-            sys.stdout.flush()
-
-        self.test_token()
-
-        if not self._has_permission("CREATE TABLE"):
-            return
-        else:
-
-            found = name in self.tables(to_list=True)
+        if mode not in _WRITE_MODES:
+            raise Exception(
+                "`mode` must be None or one of: {}".format(
+                    ", ".join(["'{}'".format(x) for x in _WRITE_MODES if x])
+                )
+            )
 
-            if (not found) and append:
+        ## Incremental appends only send the rows past the table's current
+        ## high `watermark` (recorded locally after the first lookup)
+        tracker = None
+        if mode == "incremental":
+            if watermark is None:
                 raise Exception(
-                    "Aborting write because `{}` not found int he database but `append = True`".format(
-                        name
-                    )
+                    "`watermark` must name a column when `mode = 'incremental'`"
+                )
+            if overwrite:
+                raise Exception(
+                    "`overwrite = True` can not be used with `mode = 'incremental'`"
+                )
+            tracker = _UploadWatermark(self._cache_namespace(), name, watermark)
+            if backend.remote:
+                append = name in self.tables(to_list=True)
+                query = "SELECT MAX([{}]) FROM {}".format(watermark, name)
+            else:
+                append = backend.exists(name)
+                query = "SELECT MAX({}) FROM {}".format(
+                    _quote_local(watermark), _quote_local(name)
                 )
+            ## A resumable rerun keeps the mark its first run started from
+            ## (even none); the table's MAX now includes the partial load
+            if not append:
+                tracker.mark = None
+            elif tracker.mark is None and not (resume and tracker.recorded):
+                tracker.mark = self._upload_runner(backend)(query)[0][0]
 
-            if overwrite and found:
-                self.delete_table(name)
-                if name in self.tables(to_list=True):
-                    raise Exception(
+        ## Read in pages of `batch_size` rows; only the first page (the whole
+        ## frame for a DataFrame) is used to make the table
+        source = _UploadSource(
+            dataframe,
+            batch_size,
+            columns=columns,
+            where=None if tracker is None else tracker.filter,
+        )
+        dataframe = source.first
+
+        ## Narrow sizes seen on the first page would overflow on a later one
+        if (
+            types == "narrow"
+            and not isinstance(source.data, pd.DataFrame)
+            and dataframe is not None
+            and any([x not in (dtypes or {}) for x in dataframe.columns])
+        ):
+            raise Exception(
+                "`types = 'narrow'` sizes the columns from the first page only; pin every column with `dtypes = ` or pass a DataFrame"
+            )
+
+        if sizer is not None:
+            sizer.observe(dataframe)
+
+        ## `resume` is True or a key naming the data (needed for iterators,
+        ## whose rows can't be fingerprinted without reading them)
+        upload_id = None
+        if resume:
+            upload_id = _upload_id(
+                self._cache_namespace(),
+                name,
+                source,
+                batch_size,
+                key=None if resume is True else resume,
+            )
+
+        if tracker is not None:
+            if verbose:
+                print(
+                    "Watermark `{}`: {}".format(
+                        watermark, "none" if tracker.mark is None else tracker.mark
+                    )
+                )
+                sys.stdout.flush()
+            if dataframe.shape[0] == 0:
+                tracker.save()
+                if verbose:
+                    print("No new rows for `{}`".format(name))
+                    sys.stdout.flush()
+                return
+            ## Reruns of a resumable upload must filter the same rows
+            if resume:
+                tracker.hold()
+
+        ## Merges load the rows into a staging table shaped like the target,
+        ## then apply them in one set based MERGE
+        target = name
+        if mode == "merge":
+            keys = [keys] if isinstance(keys, str) else keys
+            if not backend.remote:
+                raise Exception("`mode = 'merge'` needs a server `method`")
+            if not keys or any([x not in dataframe.columns for x in keys]):
+                raise Exception(
+                    "`keys` must name the `dataframe` columns that identify a row when `mode = 'merge'`"
+                )
+            ## A resumable merge reuses the staging table of the failed run
+            stage = upload_id if resume else uuid.uuid4().hex
+            name = "ds_stage_" + stage[:16]
+
+        if verify not in _VERIFY_MODES:
+            raise Exception(
+                "`verify` must be one of: {}".format(
+                    ", ".join(["'{}'".format(x) for x in _VERIFY_MODES])
+                )
+            )
+        ## A count after one worker's batch can include another's rows that
+        ## are committed but not yet tallied
+        if verify == "batch" and parallel > 1 and backend.connection is None:
+            raise Exception(
+                "`verify = 'batch'` can not be used with `parallel` workers; use 'count' instead"
+            )
+
+        if verbose:
+            jobstart = datetime.datetime.now()
+            print("Upload Start: {}".format(jobstart.strftime("%I:%M:%S %p")))
+            sys.stdout.flush()
+
+        ## Only a table this call creates gets the physical design (a resumed
+        ## upload created it on the first run)
+        if append or mode == "merge":
+            design = []
+
+        if backend.remote:
+
+            self.test_token()
+
+            if not self._has_permission("CREATE TABLE"):
+                return
+
+        ## Journal the committed batches; on a rerun skip the ones already in
+        ## (and leave the partly loaded table, or the one the first run made,
+        ## alone)
+        checkpoint = None
+        done = set()
+        if resume:
+            checkpoint = _UploadCheckpoint(
+                self._upload_runner(backend),
+                upload_id,
+                name,
+                remote=backend.remote,
+            )
+            done = checkpoint.committed()
+            if done:
+                overwrite, append = False, True
+                if verbose:
+                    print(
+                        "Resuming `{}`: {} batches already committed".format(
+                            name, len(done)
+                        )
+                    )
+                    sys.stdout.flush()
+            elif checkpoint.rerun:
+                overwrite = False
+                append = append or (
+                    name in self.tables(to_list=True)
+                    if backend.remote
+                    else backend.exists(name)
+                )
+
+        if not backend.remote:
+            ## e.g., a local SQLite/DuckDB engine; nothing to do on the server
+            backend.prepare(name, dataframe, overwrite=overwrite, append=append)
+            count = lambda metadata: backend.count(name)
+            ## Counting a local engine is cheap; it lets `rowcount` fall back
+            start_rows = None if verify == "none" else count(False)
+
+        else:
+
+            if mode == "merge":
+                if target not in self.tables(to_list=True):
+                    raise Exception(
+                        "Aborting merge because `{}` not found in the database".format(
+                            target
+                        )
+                    )
+                if name not in self.tables(to_list=True):
+                    ## The UNION keeps SELECT INTO from copying an IDENTITY
+                    ## property (which would refuse the staged key values)
+                    select = "SELECT {} {{}}FROM {} WHERE 1 = 0".format(
+                        ", ".join(["[" + x + "]" for x in dataframe.columns]),
+                        target,
+                    )
+                    self.query(
+                        select.format("INTO {} ".format(name))
+                        + " UNION ALL "
+                        + select.format(""),
+                        results=False,
+                    )
+                overwrite, append = False, True
+
+            found = name in self.tables(to_list=True)
+
+            if (not found) and append:
+                raise Exception(
+                    "Aborting write because `{}` not found int he database but `append = True`".format(
+                        name
+                    )
+                )
+
+            if overwrite and found:
+                self.delete_table(name)
+                if name in self.tables(to_list=True):
+                    raise Exception(
                         "Aborting write because`overwrite = True` but `{}` could not be deleted".format(
                             name
                         )
                     )
 
-            if not append:
+            count = lambda metadata: self._row_count(name, metadata=metadata)
+            ## A table this call creates starts empty; no need to count it
+            start_rows = None if append else 0
 
-                cursor = self.connection.cursor()
+            if not append:
 
                 write_query = _make_sql_schema_query(
                     dataframe=dataframe,
@@ -667,137 +1480,362 @@ class ConnectDatabase:
                     command2="",
                     additional="",
                     nullable=[True],
+                    types=types,
+                    dtypes=dtypes,
                 )
 
-                self.connection.cursor().execute(write_query)
-                self.connection.commit()
+                with self._pool.connection() as connection:
+                    self._new_cursor(connection).execute(write_query)
+                    connection.commit()
+
+                self._catalog.invalidate()
 
                 if name not in self.tables(to_list=True):
                     warnings.warn("`{}` does not appear to have written!".format(name))
 
-                cursor.close()
+            existing = list(self.get(name, n=1).columns)
+            new = list(dataframe.columns)
+            if sum([0 for i, j in zip(existing, new) if i == j]) != 0:
+                raise Exception(
+                    "Aborting because `dataframe` column names do not apprear to match the names in `{}`".format(
+                        name
+                    )
+                )
+
+        verifier = _UploadVerifier(verify, count, start=start_rows)
 
-                append = True
+        merged = False
+        try:
+            ## Batches are staged (converted) on a producer thread while the
+            ## previous batch loads; `parallel` workers each load through
+            ## their own pooled connection
+            self.upload_stats = self._upload_batches(
+                backend,
+                name,
+                source.pages(skip=done),
+                source.nrows,
+                verifier,
+                nbatches=(
+                    None
+                    if source.nrows is None or sizer is not None
+                    else len(range(0, source.nrows, batch_size))
+                ),
+                parallel=parallel if backend.connection is None else 1,
+                verbose=verbose,
+                checkpoint=checkpoint,
+                sizer=sizer,
+            )
+            if sizer is not None:
+                self.upload_decisions = sizer.decisions()
 
-            if append:
+            verifier.finish(source.sent)
 
-                existing = list(self.get(name, n=1).columns)
-                prior = self.query("SELECT COUNT(*) as N FROM {};".format(name)).iloc[
-                    0, 0
-                ]
-                new = list(dataframe.columns)
-                if sum([0 for i, j in zip(existing, new) if i == j]) != 0:
-                    raise Exception(
-                        "Aborting because `dataframe` column names do not apprear to match the names in `{}`".format(
-                            name
+            if mode == "merge":
+                affected = self._merge_stage(
+                    target, name, list(dataframe.columns), keys, delete_missing
+                )
+                merged = True
+                if verbose:
+                    print(
+                        "\n"
+                        + "Merged into `{}`: {} rows affected".format(
+                            target, "{:,}".format(affected)
                         )
                     )
+                    sys.stdout.flush()
+
+        finally:
+            ## A resumable merge keeps its staging table until it succeeds
+            if mode == "merge" and (merged or not resume):
+                ## Best effort; a failure here must not hide the original error
+                try:
+                    self.query("DROP TABLE IF EXISTS {}".format(name), results=False)
+                except Exception as e:
+                    warnings.warn(
+                        "Could not drop the staging table `{}`: {}".format(name, e)
+                    )
 
-                ## rows = _make_sql_table_rows_query(dataframe = dataframe, name = name, break_length = break_length)
-                ## self.connection.cursor().execute(rows)
-                ## self.connection.commit()
-
-                ## indat = dataframe.shape[0]
-                ## cur = self.query("SELECT COUNT(*) as N FROM {};".format(name)).iloc[0,0]
-                ## if (indat + prior != cur):
-                ##     warnings.warn("`{}` has {} rows.  Expecting {}: {} previously plus {} new for `dataframe`".format    (name,  str(cur), str(indat + prior), str(prior), str(indat)))
-                ## else:
-                ##     print("`{}` appears to have been appended".format(name), flush=True)
-
-                ## Force int to have no trailing decimal and/or zeros
-                for i in dataframe.columns:
-                    if dataframe[i].dtype == "int64":
-                        dataframe[i] = [format(j, ".0f") for j in dataframe[i]]
-
-                for i in dataframe.columns:
-                    if dataframe[i].dtype == "bool":
-                        dataframe[i] = [
-                            "1" if j else 0 if ((not j) and (j is not None)) else None
-                            for j in dataframe[i]
-                        ]
+        self._build_design(name, design, verbose=verbose)
 
-                sql_statement = "INSERT INTO {} ({}) values({})".format(
-                    name,
-                    ", ".join(["[" + x + "]" for x in dataframe.columns]),
-                    ", ".join(["?" for i in range(dataframe.shape[1])]),
-                )
+        if checkpoint is not None:
+            checkpoint.finish()
 
-                start_sql = self.query(
-                    "SELECT COUNT(*) as n FROM {}".format(name)
-                ).iloc[0, 0]
-                starts = [x for x in list(range(0, dataframe.shape[0], batch_size))]
-                ends = list(range(batch_size, dataframe.shape[0], batch_size)) + [
-                    dataframe.shape[0]
-                ]
+        if tracker is not None:
+            tracker.save()
+
+        if verbose:
+            print(
+                "\n"
+                + "Upload End: {}    {} minutes total".format(
+                    datetime.datetime.now().strftime("%I:%M:%S %p"),
+                    round((datetime.datetime.now() - jobstart).total_seconds() / 60),
+                )
+            )
+            sys.stdout.flush()
 
-                # list_df = [dataframe[s:e].copy() for s, e in zip(starts, ends)]
-                for i, s, e in zip(range(len(starts)), starts, ends):
+    def _upload_batches(
+        self,
+        backend,
+        name,
+        batches,
+        nrows: int,
+        verifier,
+        nbatches: int = None,
+        parallel: int = 1,
+        verbose: bool = True,
+        checkpoint=None,
+        sizer=None,
+    ):
 
-                    ## Grab the batch chunk
-                    df = dataframe[s:e].copy()
-                    list_of_tuples = df.values.tolist()
-                    ## Upload each batch
+        ## Never ask for more sessions than the pool allows
+        parallel = max(1, min(parallel, self._pool.size))
+
+        staged = queue.Queue(maxsize=parallel)
+        stop = threading.Event()
+        lock = threading.Lock()
+        errors = []
+        stats = [[0, 0, 0.0] for w in range(parallel)]
+        tracked = getattr(self._local, "cursors", None)
+        spans = self._profiler.stack()
+
+        ## The workers drain the queue until each gets a None, so the
+        ## producer's (blocking) puts always finish
+        def produce():
+            try:
+                for i, s, e, dataframe in batches:
+                    if stop.is_set():
+                        break
+                    if sizer is not None:
+                        sizer.observe(dataframe)
+                    ## What the batch's timing record reports
+                    info = None
+                    if self._profiler.active():
+                        info = (
+                            _insert_query(name, list(dataframe.columns)),
+                            _row_bytes(dataframe) * dataframe.shape[0],
+                        )
+                    staged.put((i, s, e, backend.stage(dataframe), info))
+            except BaseException as err:
+                errors.append(err)
+                stop.set()
+            finally:
+                for w in range(parallel):
+                    staged.put(None)
+
+        of = "" if nbatches is None else " of {}".format(nbatches)
+        total = "" if nrows is None else " of {:,}".format(nrows)
+
+        def consume(w):
+            worker = "" if parallel == 1 else " (worker {})".format(w + 1)
+            ## Share the caller's cursor tracking so a cancel reaches workers
+            if tracked is not None:
+                self._local.cursors = tracked
+            self._profiler.local.spans = spans
+            while True:
+                try:
+                    item = staged.get()
+                except BaseException as err:
+                    errors.append(err)
+                    stop.set()
+                    continue
+                if item is None:
+                    return
+                i, s, e, batch, info = item
+                if stop.is_set():
+                    backend.discard(batch)
+                    continue
+                timing = _Timing(
+                    self._profiler,
+                    "write_table",
+                    name if info is None else info[0],
+                )
+                try:
+                    start = datetime.datetime.now()
                     if verbose:
-                        start = datetime.datetime.now()
-                        print(
-                            "\n"
-                            + "    Batch {} of {} started at {}".format(
-                                i + 1, len(starts), start.strftime("%I:%M:%S     %p")
+                        with lock:
+                            print(
+                                "\n"
+                                + "    Batch {}{} started at {}{}".format(
+                                    i + 1,
+                                    of,
+                                    start.strftime("%I:%M:%S     %p"),
+                                    worker,
+                                )
                             )
-                        )
-                        sys.stdout.flush()
-                        print(
-                            "        Rows {} - {} of {}".format(
-                                "{:,}".format(s + 1),
-                                "{:,}".format(e),
-                                "{:,}".format(dataframe.shape[0]),
+                            print(
+                                "        Rows {} - {}{}".format(
+                                    "{:,}".format(s + 1), "{:,}".format(e), total
+                                )
                             )
-                        )
-                        sys.stdout.flush()
-
-                    cursor = self.connection.cursor()
-                    cursor.fast_executemany = True
-                    cursor.executemany(sql_statement, list_of_tuples)
-                    cursor.commit()
-                    cursor.close()
-
-                    ## Ensure the table is the expected size
-                    now_sql = self.query(
-                        "SELECT COUNT(*) as n FROM {}".format(name)
-                    ).iloc[0, 0]
-                    if (now_sql - start_sql) != e:
-                        warnings.warn(
-                            "The upload just uploaded up to row {}; started with {} but only {} found in the sql     table".format(
-                                e, start_sql, now_sql
+                            sys.stdout.flush()
+
+                    with self._upload_connection(backend) as connection:
+                        timing.mark("connect")
+                        cursor = self._track(connection.cursor())
+                        try:
+                            loaded = backend.load(cursor, name, batch)
+                            if checkpoint is not None:
+                                ## Same transaction as the batch's rows
+                                checkpoint.mark(cursor, s, e)
+                        finally:
+                            cursor.close()
+                        connection.commit()
+                        timing.mark("execute")
+
+                    ## Rows the driver doesn't count are reported as sent
+                    rows = e - s if loaded is None else loaded
+                    timing.rows = rows
+                    timing.bytes = None if info is None else info[1]
+                    timing.finish()
+
+                    if checkpoint is not None:
+                        checkpoint.record(s, e)
+
+                    seconds = (datetime.datetime.now() - start).total_seconds()
+
+                    with lock:
+                        stats[w][0] += 1
+                        stats[w][1] += rows
+                        stats[w][2] += seconds
+
+                        ## Ensure the table is the expected size
+                        verifier.batch(loaded, e - s)
+
+                        if verbose:
+                            print(
+                                "        Batch {} completed in {} minutes{}".format(
+                                    i + 1,
+                                    round(seconds / 60, 1),
+                                    (
+                                        ""
+                                        if nrows is None
+                                        else " ({}% complete)".format(
+                                            round(100 * e / max(nrows, 1), 1)
+                                        )
+                                    ),
+                                )
                             )
-                        )
+                            sys.stdout.flush()
+
+                    ## Let the control loop pick the size of a later batch
+                    if sizer is not None:
+                        before, after, decision = sizer.update(i, rows, seconds)
+                        if verbose:
+                            with lock:
+                                print(
+                                    "        Batch size {} -> {} rows ({})".format(
+                                        "{:,}".format(before),
+                                        "{:,}".format(after),
+                                        decision,
+                                    )
+                                )
+                                sys.stdout.flush()
+                except BaseException as err:
+                    if timing.profiler is not None and timing.rows is None:
+                        timing.error = err
+                        timing.finish()
+                    errors.append(err)
+                    stop.set()
+
+        producer = threading.Thread(target=produce, name="ds-upload-stage", daemon=True)
+        producer.start()
+
+        workers = [
+            threading.Thread(
+                target=consume,
+                args=(w,),
+                name="ds-upload-{}".format(w + 1),
+                daemon=True,
+            )
+            for w in range(1, parallel)
+        ]
+        for worker in workers:
+            worker.start()
+        consume(0)
+        for worker in workers:
+            worker.join()
+        producer.join()
 
-                    if verbose:
-                        print(
-                            "        Completed in {} minutes ({}% complete)".format(
-                                round(
-                                    (datetime.datetime.now() - start).total_seconds()
-                                    / 60,
-                                    1,
-                                ),
-                                round(100 * e / dataframe.shape[0], 1),
-                            )
-                        )
-                        sys.stdout.flush()
+        if errors:
+            raise errors[0]
+
+        out = pd.DataFrame(stats, columns=["batches", "rows", "seconds"])
+        out.insert(0, "worker", range(1, parallel + 1))
+        out["rows_per_second"] = out["rows"] / out["seconds"].where(out["seconds"] > 0)
 
         if verbose:
-            print(
-                "\n"
-                + "Upload End: {}    {} minutes total".format(
-                    start.strftime("%I:%M:%S %p"),
-                    round((datetime.datetime.now() - jobstart).total_seconds() / 60),
+            for x in out.itertuples():
+                print(
+                    "    Worker {}: {} batches, {} rows, {} rows per second".format(
+                        x.worker,
+                        x.batches,
+                        "{:,}".format(x.rows),
+                        "{:,.0f}".format(
+                            0 if pd.isnull(x.rows_per_second) else x.rows_per_second
+                        ),
+                    )
                 )
-            )
             sys.stdout.flush()
 
+        return out
+
+    def _upload_runner(self, backend):
+        ## Runs bookkeeping sql wherever the backend loads the rows
+        if not backend.remote:
+            return backend.execute
+
+        def run(query, params=None, results=True):
+            out = self.query(query, results=results, params=params)
+            return out.values.tolist() if results else None
+
+        return run
+
+    def _merge_stage(
+        self, target, stage, columns: list, keys: list, delete_missing: bool = False
+    ):
+
+        ## Identity values from the rows are inserted as they are
+        identity = self.query(
+            "SELECT name FROM sys.identity_columns WHERE object_id = OBJECT_ID(?)",
+            params=[target],
+        )["name"].tolist()
+        identity = [x for x in identity if x in columns]
+        query = _merge_query(target, stage, columns, keys, delete_missing, identity)
+
+        with self._pool.connection() as connection:
+            cursor = self._new_cursor(connection)
+            if len(identity) > 0:
+                cursor.execute("SET IDENTITY_INSERT {} ON".format(target))
+            try:
+                cursor.execute(query)
+                affected = cursor.rowcount
+            finally:
+                if len(identity) > 0:
+                    cursor.execute("SET IDENTITY_INSERT {} OFF".format(target))
+            connection.commit()
+
+        self._catalog.invalidate()
+
+        return affected
+
+    @contextmanager
+    def _upload_connection(self, backend):
+        ## Backends with their own (local) connection load through it; the
+        ## rest load through a pooled connection to the server
+        if backend.connection is None:
+            with self._pool.connection() as connection:
+                yield connection
+        else:
+            with backend.lock:
+                try:
+                    yield backend.connection
+                except BaseException:
+                    backend.connection.rollback()
+                    raise
+
     def variables(self, name=None):
 
-        out = self.query("select * from information_schema.columns")
+        out = self._information_schema_columns()
         tables = self.tables()
         out2 = pd.merge(
             out,
@@ -810,7 +1848,9 @@ class ConnectDatabase:
         if name is None:
             return out2
         else:
-            return out2[out2["TABLE_NAME"] in name]
+            return out2[
+                out2["TABLE_NAME"].isin([name] if isinstance(name, str) else name)
+            ]
 
     def describe(self):
 
@@ -883,8 +1923,12 @@ class ConnectDatabase:
         os.system("az logout")
 
     def _has_permission(self, operation: str = "CREATE TABLE"):
-        ret = self.query(
-            f"SELECT HAS_PERMS_BY_NAME(db_name(), 'DATABASE', '{operation}')"
+        ret = self._catalog.get(
+            ("permission", operation),
+            lambda: self.query(
+                "SELECT HAS_PERMS_BY_NAME(db_name(), 'DATABASE', ?)",
+                params=[operation],
+            ),
         )
 
         if ret.iloc[0, 0] != 1:
@@ -894,230 +1938,2051 @@ class ConnectDatabase:
             return True
 
 
-class _Hidden_Password_String(str):
-    def __init__(self, x):
-        self.x = x
+class UploadBackend:
 
-    def __repr__(self):
-        return re.sub(
-            r"(^.+?PWD=)(.+?)(;AUTHENTICATION=.+$)", r"\g<1>*****\g<3>", self.x
-        )
+    """
+    Bulk Load Backend for ConnectDatabase.write_table
 
+    The piece of `write_table` that moves one batch of rows into a table.  Pass an instance (or the name of a built in backend) as `write_table(..., method = )`.  Subclass it and implement `load` to add a new loader.
 
-## Helper function to make tables
-def _make_sql_table_query(
-    dataframe,
-    name: str = "@mytable",
-    break_length: int = 1000,
-    command: str = "DECLARE",
-    command2: str = "TABLE",
-    additional: str = "",
-    nullable: list = [True],
-):
+    Attributes:
+        remote: True if the backend loads into the ConnectDatabase's server (through a pooled connection); False if it loads into its own `connection`
+        connection: The backend's own DB-API connection (None for server backends)
 
-    if not isinstance(dataframe, pd.DataFrame):
-        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+    Methods:
+        stage: Convert a batch (a DataFrame with the table's columns) into what `load` takes; runs on a separate thread while the previous batch loads.  Defaults to the DataFrame itself
+        load: Insert a staged batch into `name` with `cursor` and return the number of rows loaded (None if the driver doesn't report it).  Don't commit; `write_table` commits each batch.  May be called from several threads at once (`write_table(..., parallel = )`)
+        discard: Clean up a staged batch that will never be loaded (e.g., after another batch failed)
+        prepare: Called once before the first batch for backends with their own connection (e.g., to create the table)
+        execute: Run bookkeeping sql (e.g., the `resume = True` markers) through the backend's own connection
+        count: The number of rows in `name` (backends with their own connection; used by `write_table(..., verify = )`)
+        exists: True if `name` is a table (backends with their own connection; used by `write_table(..., mode = 'incremental')`)
+    """
 
-    dec_table = _make_sql_schema_query(
-        dataframe=dataframe,
-        name=name,
-        command=command,
-        command2=command2,
-        additional=additional,
-        nullable=nullable,
-    )
+    remote = True
+    connection = None
 
-    tab = _make_sql_table_rows_query(
-        dataframe=dataframe, name=name, break_length=break_length
-    )
+    def __init__(self):
+        self.lock = threading.Lock()
 
-    return "\n".join([dec_table, " ", tab, ""])
+    def stage(self, dataframe):
+        return dataframe
 
+    def load(self, cursor, name: str, batch):
+        raise NotImplementedError("`load` must be implemented by an UploadBackend")
 
-def _make_sql_schema_query(
-    dataframe,
-    name: str = "@mytable",
-    command: str = "DECLARE",
-    command2: str = "TABLE ",
-    additional: str = "",
-    nullable: list = [True],
-):
+    def discard(self, batch):
+        pass
 
-    if not isinstance(dataframe, pd.DataFrame):
-        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+    def prepare(
+        self, name: str, dataframe, overwrite: bool = False, append: bool = False
+    ):
+        pass
 
-    ## Make the type declaration (the schema)
-    coltypes = {x: str(dataframe[x].dtype) for x in dataframe.columns}
-    charcols = [
-        k for k, v in coltypes.items() if np.isin(v, ["object", "string", "category"])
-    ]
-    if len(charcols) > 0:
-        for x in charcols:
-            dataframe[x] = dataframe[x].astype(str).str.replace("'", "''")
+    def count(self, name: str):
+        raise NotImplementedError(
+            "`count` must be implemented to verify uploads with this UploadBackend"
+        )
 
-    coltypes = {x: str(dataframe[x].dtype) for x in dataframe.columns}
+    def exists(self, name: str):
+        raise NotImplementedError(
+            "`exists` must be implemented for incremental uploads with this UploadBackend"
+        )
 
-    lookup = dict(
-        [
-            (
-                v,
-                dataframe[v]
-                .apply(lambda r: len(str(r)) if (r != None) else None)
-                .max(),
-            )
-            for v in dataframe.columns.values
-        ]
-    )
-    lookup = {
-        k: str(int(v) + 200) if not pd.isnull(v) else None for k, v in lookup.items()
-    }
-    lookup = {
-        k: (v if coltypes.get(k) == "object" else None) for k, v in lookup.items()
-    }
-    lookup = {
-        k: v if (v is None) or (int(v) < 7000) else "Max" for k, v in lookup.items()
-    }
-
-    def sql_type(x):
-        out = []
-        for i in x:
-            if i in ["float64", "float32"]:
-                out.append("NUMERIC(32, 5)")
-            elif i in ["int32", "int64"]:
-                out.append("INT")
-            elif i == "datetime64":
-                out.append("DATETIME")
-            elif i == "datetime64[ns]":
-                out.append("DATETIME")
-            elif i == "bool":
-                out.append("INT")
-            else:
-                out.append("VARCHAR({})")
+    def execute(self, query: str, params=None, results: bool = True):
+        raise NotImplementedError(
+            "`execute` must be implemented to resume uploads with this UploadBackend"
+        )
 
-        return out
 
-    types = sql_type(coltypes.values())
-    types = [
-        x.format(z) if z is not None else x for x, z in zip(types, lookup.values())
-    ]
+class ExecuteManyBackend(UploadBackend):
 
-    if additional != "":
-        "\n" + additional
+    """
+    Parameter Binding Upload Backend
 
-    if len(nullable) == 1:
-        nullable = [nullable[0] for i in range(len(types))]
+    Inserts each batch with pyodbc's `executemany` and `fast_executemany` (the default `write_table` loader).
+    """
 
-    nn = []
-    for i in range(len(nullable)):
-        if nullable[i]:
-            nn.append("")
-        else:
-            nn.append(" NOT NULL")
+    def stage(self, dataframe):
+        return list(dataframe.columns), _upload_rows(dataframe)
 
-    nullable = nn
+    def load(self, cursor, name: str, batch):
 
-    dec_table = "{} {} {}(\n{}{}\n)".format(
-        command,
-        name,
-        command2,
-        ",\n".join(
-            [
-                "    [{}] {}{}".format(x, y, z)
-                for x, y, z in zip(dataframe.columns, types, nullable)
-            ]
-        ),
-        additional,
-    )
+        columns, rows = batch
 
-    return dec_table
+        cursor.fast_executemany = True
+        cursor.executemany(_insert_query(name, columns), rows)
 
+        return cursor.rowcount if cursor.rowcount >= 0 else None
 
-def _make_sql_table_rows_query(dataframe, name: str, break_length: int = 1000):
 
-    if not isinstance(dataframe, pd.DataFrame):
-        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+class BulkInsertBackend(UploadBackend):
 
-    ## Insert statement
-    tab_insert = "REMOVEME123321insert into [{}] valuesDELETEME123321".format(name)
+    """
+    Staged File Upload Backend
 
-    ## Force int to have no trailing decimal and/or zeros
-    for i in dataframe.columns:
-        if dataframe[i].dtype == "int64":
-            dataframe[i] = [format(j, ".0f") for j in dataframe[i]]
+    Writes each batch to a delimited file in a folder the server can read and loads it with `BULK INSERT`, which skips per row parameter binding.  The fields are separated by control characters (0x1F between fields, 0x1E between rows) so text never needs quoting.  Empty strings load as NULL.
 
-    for i in dataframe.columns:
-        if dataframe[i].dtype == "bool":
-            dataframe[i] = [
-                "1" if j else 0 if ((not j) and (j is not None)) else None
-                for j in dataframe[i]
-            ]
+    Parameters:
+        stage_dir: The local folder the batch files are written to; defaults to the temp directory
+        server_dir: The same folder as the server sees it (e.g., a UNC share); defaults to `stage_dir`
+        data_source: The name of an external data source (required by Azure SQL Database, where `server_dir` is then the path within the blob container)
+        keep_files: If True the batch files are not deleted after loading
+    """
 
-    ## Concatenate rows
-    rows = []
-    for i in range(dataframe.shape[0]):
-        rows.append(
-            "("
-            + ", ".join(
-                [
-                    "NULL" if pd.isnull(x) else "'" + str(x) + "'"
-                    for x in dataframe.iloc[
-                        i,
-                    ]
-                ]
-            )
-            + ")"
-        )
+    field_terminator = "\x1f"
+    row_terminator = "\x1e"
 
-    ## Insert the break
-    if len(rows) > break_length:
-        for i in range(break_length, len(rows) + break_length, break_length + 1):
-            if i == len(rows):
-                break
-            rows.insert(i, tab_insert)
+    def __init__(
+        self,
+        stage_dir: str = None,
+        server_dir: str = None,
+        data_source: str = None,
+        keep_files: bool = False,
+    ):
+        super().__init__()
+        self.stage_dir = tempfile.gettempdir() if stage_dir is None else stage_dir
+        self.server_dir = self.stage_dir if server_dir is None else server_dir
+        self.data_source = data_source
+        self.keep_files = keep_files
 
-    rows = [re.sub("REMOVEME123321", "", tab_insert)] + rows
+    def stage(self, dataframe):
 
-    tab = re.sub(
-        ",\nREMOVEME123321", "\n", re.sub("DELETEME123321,", "", ",\n".join(rows))
-    )
+        file = "ds_stage_{}.txt".format(uuid.uuid4().hex)
 
-    return tab
+        with open(
+            os.path.join(self.stage_dir, file), "w", encoding="utf-8", newline=""
+        ) as stream:
+            stream.write(
+                _delimited_text(dataframe, self.field_terminator, self.row_terminator)
+            )
 
+        return file, dataframe.shape[0]
 
-## Helpers to get a token rom Azure's CLI for use in the connection string
-class _DataBaseCredentialWrapper:
-    def __init__(
-        self,
-        resource="https://database.windows.net/",
-        tenant: str = None,
-        tenantid: str = None,
-    ):
-        self.resource = resource
+    def load(self, cursor, name: str, batch):
 
-        if tenantid is None:
-            tenantidi = ""
-        else:
-            tenantidi = "--tenant " + tenantid
+        file, nrows = batch
+        remote = (
+            self.server_dir.rstrip("/\\")
+            + ("/" if "/" in self.server_dir else "\\")
+            + file
+        )
+
+        options = [
+            "FIELDTERMINATOR = '{}'".format(self.field_terminator),
+            "ROWTERMINATOR = '{}'".format(self.row_terminator),
+            "CODEPAGE = '65001'",
+            "KEEPNULLS",
+            "TABLOCK",
+        ]
+        if self.data_source is not None:
+            options.append("DATA_SOURCE = '{}'".format(self.data_source))
 
         try:
-            result = subprocess.check_output("az account show", shell=True)
-        except Exception as e:
-            result = ""
+            cursor.execute(
+                "BULK INSERT {} FROM '{}' WITH ({})".format(
+                    name, remote.replace("'", "''"), ", ".join(options)
+                )
+            )
+            loaded = cursor.rowcount
+        finally:
+            self.discard(batch)
 
-        if result != "":
-            # if (json.loads(result).get('tenantId') != tenantid) and (tenantid is not None):
-            #    os.system('az logout')
-            az_tenant = re.sub(
-                "^.+@|\\.com$", "", json.loads(result).get("user").get("name")
-            ).lower()
-            if tenant != az_tenant:
-                os.system("az logout")
+        ## None: the driver didn't say (the verifier falls back to a count)
+        return loaded if loaded >= 0 else None
 
-        self.cred = AzureCliCredential()
+    def discard(self, batch):
+        if not self.keep_files:
+            _remove_quietly(os.path.join(self.stage_dir, batch[0]))
 
-        try:
-            self.cli_token = self.cred.get_token(self.resource)
-        except Exception as e:
+
+class LocalEngineBackend(UploadBackend):
+
+    """
+    Local Engine Upload Backend
+
+    Loads the batches into a local DB-API engine (e.g., SQLite or DuckDB) instead of the server.  Useful for testing uploads offline and for staging data locally.  The table is created in the engine when it does not exist.
+
+    Parameters:
+        connection: A DB-API connection that takes `?` placeholders (e.g., `sqlite3.connect('stage.db')` or `duckdb.connect('stage.duckdb')`)
+    """
+
+    remote = False
+
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+
+    def prepare(
+        self, name: str, dataframe, overwrite: bool = False, append: bool = False
+    ):
+
+        cursor = self.connection.cursor()
+        try:
+            if overwrite:
+                cursor.execute("DROP TABLE IF EXISTS {}".format(_quote_local(name)))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {} ({})".format(
+                    _quote_local(name),
+                    ", ".join(
+                        [
+                            "{} {}".format(_quote_local(x), _local_type(dataframe[x]))
+                            for x in dataframe.columns
+                        ]
+                    ),
+                )
+            )
+            self.connection.commit()
+        finally:
+            cursor.close()
+
+    def stage(self, dataframe):
+        return list(dataframe.columns), _upload_rows(dataframe, "%Y-%m-%d %H:%M:%S.%f")
+
+    def load(self, cursor, name: str, batch):
+
+        columns, rows = batch
+
+        cursor.executemany(
+            "INSERT INTO {} ({}) VALUES ({})".format(
+                _quote_local(name),
+                ", ".join([_quote_local(x) for x in columns]),
+                ", ".join(["?" for i in columns]),
+            ),
+            rows,
+        )
+
+        return cursor.rowcount if cursor.rowcount >= 0 else None
+
+    def count(self, name: str):
+        return self.execute("SELECT COUNT(*) FROM {}".format(_quote_local(name)))[0][0]
+
+    def exists(self, name: str):
+        try:
+            self.execute("SELECT 1 FROM {} WHERE 1 = 0".format(_quote_local(name)))
+        except Exception:
+            self.connection.rollback()
+            return False
+        return True
+
+    def execute(self, query: str, params=None, results: bool = True):
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(query, [] if params is None else params)
+                if results:
+                    return [tuple(x) for x in cursor.fetchall()]
+                self.connection.commit()
+            finally:
+                cursor.close()
+
+
+## Checks that the rows write_table sent actually landed:
+##   rowcount: the rows the driver reports per batch (no queries; default).
+##     Drivers that report -1 (e.g., pyodbc after some executemany calls)
+##     fall back to one COUNT(*) at the end when the starting size is known
+##   count: one COUNT(*) at the end
+##   metadata: the row count from sys.dm_db_partition_stats at the end
+##   batch: a COUNT(*) after every batch (slow on large tables)
+##   none: no checks
+_VERIFY_MODES = ["rowcount", "count", "metadata", "batch", "none"]
+
+
+class _UploadVerifier:
+    def __init__(self, mode: str, count, start: int = None):
+        self.mode = mode
+        self.count = count
+        self.loaded = 0
+        self.start = start
+
+        if mode in ["count", "metadata", "batch"] and start is None:
+            self.start = self.count(mode == "metadata")
+
+    def batch(self, loaded: int, expected: int):
+
+        if loaded is None:
+            if self.mode == "rowcount":
+                self.unknown(expected)
+            loaded = expected
+
+        self.loaded += loaded
+
+        if self.mode == "rowcount" and loaded != expected:
+            warnings.warn(
+                "The upload just loaded {} rows but the batch had {}".format(
+                    loaded, expected
+                )
+            )
+        elif self.mode == "batch":
+            now = self.count(False)
+            if (now - self.start) != self.loaded:
+                warnings.warn(
+                    "The upload just uploaded up to row {}; started with {} but only {} found in the sql     table".format(
+                        self.loaded, self.start, now
+                    )
+                )
+
+    def unknown(self, expected: int):
+        ## Warn once, then check the whole upload with a COUNT(*) at the end
+        if self.start is None:
+            warnings.warn(
+                "The driver does not report how many rows each batch loaded, so the upload can't be checked with `verify = 'rowcount'`; use `verify = 'count'`"
+            )
+            self.mode = "none"
+        else:
+            warnings.warn(
+                "The driver does not report how many rows each batch loaded; checking the upload with a COUNT(*) when it finishes instead"
+            )
+            self.mode = "count"
+
+    def finish(self, expected: int):
+
+        if self.mode in ["count", "metadata"]:
+            now = self.count(self.mode == "metadata")
+            if (now - self.start) != expected:
+                warnings.warn(
+                    "The upload sent {} rows; started with {} but {} found in the sql table".format(
+                        expected, self.start, now
+                    )
+                )
+
+
+## `batch_size = 'auto'`: additive increase, multiplicative decrease over the
+## committed batches.  The size doubles (slow start) until the first slow
+## batch, then grows by `_AUTO_BATCH_START` rows at a time; a batch past
+## `_AUTO_BATCH_SECONDS` or a drop in rows per second halves it.  Pages stay
+## under `_AUTO_BATCH_BYTES` of DataFrame memory, which bounds both the
+## driver's buffers and the log a batch's transaction writes.
+_AUTO_BATCH_START = 10000
+_AUTO_BATCH_MIN = 1000
+_AUTO_BATCH_MAX = 1000000
+_AUTO_BATCH_BYTES = 64 * 2**20
+_AUTO_BATCH_SECONDS = 30
+
+
+class _BatchSizer:
+    def __init__(self, start: int = _AUTO_BATCH_START):
+
+        self.size = start
+        self.step = start
+        self.slow_start = True
+        self.row_bytes = None
+        self.rate = None
+        self.lock = threading.Lock()
+        self.log = []
+
+    def __call__(self):
+        with self.lock:
+            return self.size
+
+    def observe(self, dataframe):
+        if dataframe.shape[0] == 0:
+            return
+        row_bytes = _row_bytes(dataframe)
+        with self.lock:
+            self.row_bytes = max(row_bytes, self.row_bytes or 0)
+            self.size = min(self.size, self._limit())
+
+    def _limit(self):
+        limit = _AUTO_BATCH_MAX
+        if self.row_bytes:
+            limit = min(limit, int(_AUTO_BATCH_BYTES / self.row_bytes))
+        return max(_AUTO_BATCH_MIN, limit)
+
+    def update(self, batch: int, rows: int, seconds: float):
+
+        with self.lock:
+            before = self.size
+            rate = rows / seconds if seconds > 0 else None
+
+            if rate is None:
+                decision = "hold"
+            elif seconds > _AUTO_BATCH_SECONDS:
+                decision = "halve; slower than {} seconds".format(_AUTO_BATCH_SECONDS)
+            elif self.rate is not None and rate < 0.8 * self.rate:
+                decision = "halve; rows per second dropped"
+            elif self.slow_start:
+                decision = "double"
+            else:
+                decision = "grow"
+
+            if decision.startswith("halve"):
+                self.slow_start = False
+                self.size = before // 2
+            elif decision == "double":
+                self.size = before * 2
+            elif decision == "grow":
+                self.size = before + self.step
+
+            self.size = max(_AUTO_BATCH_MIN, min(self.size, self._limit()))
+            if self.size == before and decision != "hold":
+                decision = "hold; at the {} row limit".format("{:,}".format(self.size))
+
+            if rate is not None:
+                self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+
+            self.log.append(
+                [batch + 1, rows, seconds, rate, self.row_bytes, self.size, decision]
+            )
+
+            return before, self.size, decision
+
+    def decisions(self):
+        with self.lock:
+            return pd.DataFrame(
+                self.log,
+                columns=[
+                    "batch",
+                    "rows",
+                    "seconds",
+                    "rows_per_second",
+                    "bytes_per_row",
+                    "batch_size",
+                    "decision",
+                ],
+            )
+
+
+## Resumable uploads: each committed batch range is recorded in a marker
+## table (in the batch's own transaction) and in a local journal file
+_CHECKPOINT_TABLE = "ds_upload_checkpoint"
+
+
+class _UploadCheckpoint:
+    def __init__(self, run, upload_id: str, name: str, remote: bool = True):
+
+        self.run = run
+        self.upload_id = upload_id
+        self.name = name
+        self.lock = threading.Lock()
+
+        directory = os.path.join(os.path.expanduser("~"), ".ds_upload_journal")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, upload_id + ".json")
+
+        ## The journal is started up front, so a rerun knows an earlier run
+        ## got this far (and may have made the table) even with no batch in
+        self.journal = {"upload_id": upload_id, "table": name, "committed": []}
+        self.rerun = False
+        try:
+            with open(self.path) as f:
+                self.journal = json.load(f)
+            self.rerun = True
+        except (OSError, ValueError):
+            self._write()
+
+        if remote:
+            create = "IF OBJECT_ID('{0}') IS NULL CREATE TABLE {0} (upload_id VARCHAR(64), table_name NVARCHAR(256), batch_start BIGINT, batch_end BIGINT, committed_at DATETIME DEFAULT GETDATE())"
+        else:
+            create = "CREATE TABLE IF NOT EXISTS {0} (upload_id VARCHAR(64), table_name VARCHAR(256), batch_start BIGINT, batch_end BIGINT)"
+        self.run(create.format(_CHECKPOINT_TABLE), results=False)
+
+    def committed(self):
+        ## The marker rows commit with the batches, so they win over the
+        ## journal (which is written just after each commit)
+        try:
+            rows = self.run(
+                "SELECT batch_start, batch_end FROM {} WHERE upload_id = ?".format(
+                    _CHECKPOINT_TABLE
+                ),
+                params=[self.upload_id],
+            )
+        except Exception as e:
+            warnings.warn(
+                "Could not read the upload markers ({}); resuming from the local journal".format(
+                    e
+                )
+            )
+            rows = self.journal["committed"]
+
+        return set([int(x[0]) for x in rows])
+
+    def mark(self, cursor, start: int, end: int):
+        cursor.execute(
+            "INSERT INTO {} (upload_id, table_name, batch_start, batch_end) VALUES (?, ?, ?, ?)".format(
+                _CHECKPOINT_TABLE
+            ),
+            [self.upload_id, self.name, int(start), int(end)],
+        )
+
+    def record(self, start: int, end: int):
+        with self.lock:
+            self.journal["committed"].append([int(start), int(end)])
+            self._write()
+
+    def _write(self):
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.journal, f)
+        os.replace(temp, self.path)
+
+    def finish(self):
+        self.run(
+            "DELETE FROM {} WHERE upload_id = ?".format(_CHECKPOINT_TABLE),
+            params=[self.upload_id],
+            results=False,
+        )
+        _remove_quietly(self.path)
+
+
+## Incremental uploads: the high watermark of each table's monotonic column,
+## kept next to the upload journals so later runs can skip the MAX lookup
+class _UploadWatermark:
+    def __init__(self, namespace: str, name: str, column: str):
+
+        self.column = column
+        self.key = "|".join([namespace, str(name), str(column)])
+        self.high = None
+
+        directory = os.path.join(os.path.expanduser("~"), ".ds_upload_journal")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "watermarks.json")
+
+        marks = self._read()
+        self.recorded = self.key in marks
+        self.mark = _watermark_load(marks.get(self.key))
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def filter(self, dataframe):
+
+        if self.column not in dataframe.columns:
+            raise Exception(
+                "`watermark` column `{}` not found in `dataframe`".format(self.column)
+            )
+
+        col = dataframe[self.column]
+        if self.mark is not None:
+            mask = _watermark_mask(col, self.mark)
+            if not mask.all():
+                dataframe = dataframe.loc[mask]
+                col = dataframe[self.column]
+
+        if col.shape[0] > 0:
+            top = col.max()
+            if not pd.isna(top) and (self.high is None or top > self.high):
+                self.high = top
+
+        return dataframe
+
+    def save(self):
+        ## Once the load commits: the highest value sent
+        value = self.mark if self.high is None else self.high
+        if value is not None:
+            self._write(value)
+
+    def hold(self):
+        ## Before a resumable load: the mark it starts from (None included,
+        ## meaning "send every row"), so a rerun filters the same rows
+        self._write(self.mark)
+
+    def _write(self, value):
+        marks = self._read()
+        marks[self.key] = _watermark_dump(value)
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(marks, f)
+        os.replace(temp, self.path)
+
+
+## Rows strictly past `mark`; rows with a missing watermark are not sent
+def _watermark_mask(col, mark):
+    if pd.api.types.is_datetime64_any_dtype(col):
+        mark = pd.Timestamp(mark)
+    return (col > mark).fillna(False).to_numpy(dtype=bool)
+
+
+def _watermark_dump(value):
+    if isinstance(value, (datetime.date, np.datetime64)):
+        return {"datetime": pd.Timestamp(value).isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _watermark_load(value):
+    if isinstance(value, dict):
+        return pd.Timestamp(value["datetime"])
+    return value
+
+
+## The same data, going to the same table in the same batches, resumes
+def _upload_id(namespace: str, name: str, source, batch_size: int, key: str = None):
+    return _hash_text(
+        "|".join(
+            [
+                namespace,
+                str(name),
+                str(batch_size),
+                str(list(source.first.columns)),
+                source.fingerprint() if key is None else "key|" + str(key),
+            ]
+        )
+    )[:32]
+
+
+## The rows write_table uploads, as pages of (at most) `batch_size` rows:
+## a DataFrame, an iterator of DataFrames, an iterator of tuples (named by
+## `columns`), or the path to a CSV or Parquet file.  Streamed sources are
+## read a page at a time.
+class _UploadSource:
+    def __init__(self, data, batch_size: int, columns: list = None, where=None):
+
+        ## `batch_size` may be a callable (e.g., a _BatchSizer) that gives the
+        ## size of the next page; files and tuples are read at its start size
+        self.batch_size = batch_size
+        self.sent = 0
+        if callable(batch_size):
+            batch_size = batch_size()
+
+        ## `where` filters each DataFrame (or page) before it's paged
+        if isinstance(data, pd.DataFrame) and where is not None:
+            data = where(data)
+        self.data = data
+
+        if isinstance(data, pd.DataFrame):
+            self.nrows = data.shape[0]
+            self.first = data
+            self._pages = None
+            return
+
+        if isinstance(data, (str, os.PathLike)):
+            frames, self.nrows = _read_pages(data, batch_size)
+        else:
+            self.nrows = None
+            frames = iter(data)
+            head = next(frames, None)
+            if head is None:
+                frames = iter([])
+            elif isinstance(head, pd.DataFrame):
+                frames = _prepend(head, frames)
+            elif columns is None:
+                raise Exception("`columns` must be given to upload rows of tuples")
+            else:
+                frames = _tuple_pages(_prepend(head, frames), columns, batch_size)
+
+        if where is not None:
+            frames = map(where, frames)
+
+        self._pages = _repage(frames, self.batch_size)
+        self.first = next(self._pages, None)
+        if self.first is None:
+            self.first = pd.DataFrame(columns=[] if columns is None else columns)
+
+    def fingerprint(self):
+        if self._pages is None:
+            return hashlib.sha256(
+                pd.util.hash_pandas_object(self.data, index=False).to_numpy().tobytes()
+            ).hexdigest()
+        elif isinstance(self.data, (str, os.PathLike)):
+            info = os.stat(self.data)
+            return "{}|{}|{}".format(
+                os.path.abspath(self.data), info.st_size, info.st_mtime
+            )
+        else:
+            raise Exception(
+                "`resume = True` can not tell one iterator's rows from another's; name the data with `resume = 'key'` (e.g., the extract's date) instead"
+            )
+
+    def pages(self, skip=set()):
+
+        if self._pages is None:
+            frames = _repage(iter([self.data]), self.batch_size)
+        elif self.first.shape[0] == 0:
+            frames = iter([])
+        else:
+            ## Don't hold on to the first page once it is sent
+            first, self.first = self.first, self.first.iloc[:0]
+            frames = _prepend(first, self._pages)
+
+        s = 0
+        for i, page in enumerate(frames):
+            e = s + page.shape[0]
+            if s not in skip:
+                self.sent += e - s
+                yield i, s, e, page
+            s = e
+
+
+def _read_pages(path, batch_size: int):
+    if os.fspath(path).lower().endswith((".parquet", ".pq")):
+        import pyarrow.parquet as pq
+
+        file = pq.ParquetFile(path)
+        return (
+            x.to_pandas() for x in file.iter_batches(batch_size=batch_size)
+        ), file.metadata.num_rows
+    else:
+        return iter(pd.read_csv(path, chunksize=batch_size)), None
+
+
+def _tuple_pages(rows, columns: list, batch_size: int):
+    while True:
+        page = list(islice(rows, batch_size))
+        if not page:
+            return
+        yield pd.DataFrame.from_records(page, columns=columns)
+
+
+## Cut (or glue) a stream of DataFrames into pages of exactly `batch_size`
+## rows (the last may be shorter); a callable `batch_size` is asked again
+## before each page
+def _repage(frames, batch_size):
+
+    limit = batch_size() if callable(batch_size) else batch_size
+    buffer, size = [], 0
+
+    for frame in frames:
+        while frame.shape[0] > 0:
+            take = frame.iloc[: limit - size]
+            frame = frame.iloc[take.shape[0] :]
+            buffer.append(take)
+            size += take.shape[0]
+            if size == limit:
+                yield _concat_pages(buffer)
+                buffer, size = [], 0
+                limit = batch_size() if callable(batch_size) else batch_size
+
+    if size > 0:
+        yield _concat_pages(buffer)
+
+
+def _concat_pages(buffer: list):
+    if len(buffer) == 1:
+        return buffer[0]
+    return pd.concat(buffer, ignore_index=True)
+
+
+## Physical design, built after the load: a clustered columnstore or a
+## clustered (rowstore) key, page/row compression, and secondary indexes
+_COMPRESSIONS = ["page", "row"]
+
+
+def _make_sql_design_queries(
+    name: str,
+    columnstore: bool = False,
+    compression: str = None,
+    clustered: list = None,
+    indexes: list = None,
+):
+
+    clustered = [clustered] if isinstance(clustered, str) else clustered
+    indexes = [[x] if isinstance(x, str) else list(x) for x in indexes or []]
+
+    if compression is not None and compression.lower() not in _COMPRESSIONS:
+        raise Exception(
+            "`compression` must be None or one of: {}".format(
+                ", ".join(["'{}'".format(x) for x in _COMPRESSIONS])
+            )
+        )
+    if columnstore and (clustered or compression is not None):
+        raise Exception(
+            "A clustered columnstore can not be combined with `clustered` or `compression` (it is compressed already)"
+        )
+
+    prefix = re.sub(r"\W+", "_", str(name)).strip("_")
+    options = (
+        ""
+        if compression is None
+        else " WITH (DATA_COMPRESSION = {})".format(compression.upper())
+    )
+
+    out = []
+    if columnstore:
+        out.append(
+            "CREATE CLUSTERED COLUMNSTORE INDEX [cci_{}] ON {}".format(
+                prefix[:100], name
+            )
+        )
+    elif clustered:
+        out.append(
+            "CREATE CLUSTERED INDEX [cx_{}] ON {} ({}){}".format(
+                prefix[:100],
+                name,
+                ", ".join(["[" + x + "]" for x in clustered]),
+                options,
+            )
+        )
+    elif compression is not None:
+        out.append("ALTER TABLE {} REBUILD{}".format(name, options))
+
+    for columns in indexes:
+        out.append(
+            "CREATE NONCLUSTERED INDEX [{}] ON {} ({}){}".format(
+                "ix_{}_{}".format(prefix, "_".join(columns))[:128],
+                name,
+                ", ".join(["[" + x + "]" for x in columns]),
+                options,
+            )
+        )
+
+    return out
+
+
+## `write_table(..., mode = )`; None follows `overwrite`/`append`
+_WRITE_MODES = [None, "merge", "incremental"]
+
+
+## Update the target's matching rows, insert the new ones, and (optionally)
+## delete the ones the staged rows don't have
+def _merge_query(
+    target: str,
+    stage: str,
+    columns: list,
+    keys: list,
+    delete_missing: bool = False,
+    identity: list = None,
+):
+
+    identity = identity or []
+    values = [x for x in columns if x not in keys and x not in identity]
+
+    out = [
+        "MERGE {} WITH (HOLDLOCK) AS t".format(target),
+        "USING {} AS s".format(stage),
+        "ON " + " AND ".join(["t.[{0}] = s.[{0}]".format(x) for x in keys]),
+    ]
+    if len(values) > 0:
+        out.append(
+            "WHEN MATCHED THEN UPDATE SET "
+            + ", ".join(["t.[{0}] = s.[{0}]".format(x) for x in values])
+        )
+    out.append(
+        "WHEN NOT MATCHED BY TARGET THEN INSERT ({}) VALUES ({})".format(
+            ", ".join(["[" + x + "]" for x in columns]),
+            ", ".join(["s.[" + x + "]" for x in columns]),
+        )
+    )
+    if delete_missing:
+        out.append("WHEN NOT MATCHED BY SOURCE THEN DELETE")
+
+    return "\n".join(out) + ";"
+
+
+_UPLOAD_BACKENDS = {"executemany": ExecuteManyBackend, "bulk": BulkInsertBackend}
+
+
+def _upload_backend(method):
+    if isinstance(method, UploadBackend):
+        return method
+    elif method in _UPLOAD_BACKENDS:
+        return _UPLOAD_BACKENDS[method]()
+    else:
+        raise Exception(
+            "`method` must be an UploadBackend or one of: {}".format(
+                ", ".join(["'{}'".format(x) for x in _UPLOAD_BACKENDS])
+            )
+        )
+
+
+def _insert_query(name: str, columns):
+    return "INSERT INTO {} ({}) values({})".format(
+        name,
+        ", ".join(["[" + x + "]" for x in columns]),
+        ", ".join(["?" for i in columns]),
+    )
+
+
+## Batches are converted as they are loaded, column by column, to the Python
+## types the drivers bind natively (NaN/NaT -> None, bool -> 0/1); the
+## caller's DataFrame is never modified
+def _upload_rows(dataframe, datetime_format: str = None):
+    return list(
+        zip(
+            *[
+                _upload_column(dataframe.iloc[:, j], datetime_format)
+                for j in range(dataframe.shape[1])
+            ]
+        )
+    )
+
+
+def _upload_column(col, datetime_format: str = None):
+
+    kind = col.dtype.kind
+    native = isinstance(col.dtype, np.dtype)
+
+    if native and kind == "b":
+        return col.to_numpy(dtype="int8").tolist()
+    elif native and kind in "iu":
+        return col.to_numpy().tolist()
+    elif kind == "b":
+        ## e.g., pandas' nullable "boolean"
+        col = col.astype(object).map(int, na_action="ignore")
+
+    if kind == "M" and datetime_format is not None:
+        out = col.dt.strftime(datetime_format).to_numpy(dtype=object)
+    elif kind == "M":
+        out = col.array.to_pydatetime()
+    else:
+        out = col.to_numpy(dtype=object, copy=True)
+
+    missing = col.isna().to_numpy()
+    if missing.any():
+        out[missing] = None
+
+    return out.tolist()
+
+
+def _delimited_text(dataframe, field_terminator: str, row_terminator: str):
+
+    if dataframe.shape[0] == 0:
+        return ""
+
+    fields = []
+    for x in dataframe.columns:
+        col = dataframe[x]
+        if col.dtype.kind == "M":
+            text = col.dt.strftime("%Y-%m-%d %H:%M:%S.%f").str[:-3]
+        elif col.dtype.kind == "b":
+            text = col.astype("int8").astype(str)
+        elif col.dtype.kind == "f":
+            ## Fixed point and no trailing `.0` (SQL Server won't convert
+            ## `1e-05` to NUMERIC or `1.0` to INT)
+            precision = "float32" if col.dtype == "float32" else "float64"
+            text = pd.Series(
+                [
+                    np.format_float_positional(v, trim="-")
+                    for v in col.to_numpy(dtype=precision, na_value=np.nan)
+                ],
+                index=col.index,
+            )
+        else:
+            text = col.astype(str)
+        text = text.where(col.notna(), "")
+        if (
+            text.str.contains(field_terminator, regex=False).any()
+            or text.str.contains(row_terminator, regex=False).any()
+        ):
+            raise Exception(
+                "Column `{}` contains the 0x1F/0x1E characters used to delimit the staged file".format(
+                    x
+                )
+            )
+        fields.append(text.reset_index(drop=True))
+
+    rows = (
+        fields[0].str.cat(fields[1:], sep=field_terminator)
+        if len(fields) > 1
+        else fields[0]
+    )
+
+    return row_terminator.join(rows.to_list()) + row_terminator
+
+
+def _quote_local(x: str):
+    return '"' + str(x).replace('"', '""') + '"'
+
+
+def _local_type(col):
+    kind = col.dtype.kind
+    if kind == "b":
+        return "BOOLEAN"
+    elif kind in "iu":
+        return "BIGINT"
+    elif kind == "f":
+        return "DOUBLE"
+    elif kind == "M":
+        return "TIMESTAMP"
+    else:
+        return "TEXT"
+
+
+## Per connection cache of catalog (metadata) lookups; emptied by a TTL and
+## by any DDL run through ConnectDatabase
+class _CatalogCache:
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+
+        with self._lock:
+            found = self._entries.get(key)
+            generation = self._generation
+
+        if (found is not None) and (time() - found[0] < self.ttl):
+            return found[1]
+
+        value = load()
+
+        ## Don't store a result that was loaded across an invalidation
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time(), value)
+
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+            self._generation += 1
+
+
+def _like_to_regex(term):
+    return "".join(
+        ".*" if x == "%" else "." if x == "_" else re.escape(x) for x in str(term)
+    )
+
+
+## On disk, content addressed store of query results with a TTL and a least
+## recently used size bound.  Files are written once (mtime) and touched on
+## every hit (atime), so both can be read straight off the file system.
+class _QueryCache:
+    def __init__(
+        self, directory: str = None, ttl: float = 86400, max_bytes: int = 2 * 1024**3
+    ):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser("~"), ".ds_query_cache")
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def key(self, query: str, engine: str = "pandas", params: list = None):
+        text = [engine, _normalize_sql(query)]
+        if params is not None:
+            text.append(repr(list(params)))
+        return _hash_text("\n".join(text))
+
+    def get(self, namespace: str, key: str):
+
+        for path, read in self._paths(namespace, key):
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+
+            if time() - info.st_mtime > self.ttl:
+                _remove_quietly(path)
+                return None
+
+            try:
+                out = read(path)
+                os.utime(path, (time(), info.st_mtime))
+                return out
+            except Exception:
+                ## Unreadable (or evicted by another process mid read)
+                _remove_quietly(path)
+                return None
+
+        return None
+
+    def put(self, namespace: str, key: str, dataframe):
+
+        folder = os.path.join(self.directory, namespace)
+        temp = os.path.join(
+            folder, "{}.{}.{}.tmp".format(key, os.getpid(), threading.get_ident())
+        )
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+            try:
+                dataframe.to_parquet(temp, index=False)
+                path = os.path.join(folder, key + ".parquet")
+            except Exception:
+                ## No pyarrow, or columns parquet can not store
+                dataframe.to_pickle(temp)
+                path = os.path.join(folder, key + ".pkl")
+            os.replace(temp, path)
+        except OSError:
+            _remove_quietly(temp)
+            warnings.warn("Could not save the query result in '{}'".format(folder))
+            return
+
+        self._evict()
+
+    def clear(self, namespace: str, key: str = None):
+
+        if key is not None:
+            for path, read in self._paths(namespace, key):
+                _remove_quietly(path)
+            return
+
+        folder = os.path.join(self.directory, namespace)
+        if os.path.isdir(folder):
+            for x in os.listdir(folder):
+                _remove_quietly(os.path.join(folder, x))
+
+    def _paths(self, namespace: str, key: str):
+        folder = os.path.join(self.directory, namespace)
+        return [
+            (os.path.join(folder, key + ".parquet"), pd.read_parquet),
+            (os.path.join(folder, key + ".pkl"), pd.read_pickle),
+        ]
+
+    def _evict(self):
+
+        found = []
+        for folder, dirs, files in os.walk(self.directory):
+            for x in files:
+                path = os.path.join(folder, x)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                if (time() - info.st_mtime > self.ttl) and not x.endswith(".tmp"):
+                    _remove_quietly(path)
+                else:
+                    found.append((info.st_atime, info.st_size, path))
+
+        ## Least recently used go first
+        total = sum([x[1] for x in found])
+        for atime, size, path in sorted(found):
+            if total <= self.max_bytes:
+                break
+            if not path.endswith(".tmp"):
+                _remove_quietly(path)
+                total -= size
+
+
+def _normalize_sql(query: str):
+    ## Collapse runs of white space (and drop a trailing semicolon) outside of
+    ## quoted literals so formatting differences share one cache entry
+    parts = re.split("('(?:[^']|'')*')", query.strip())
+    parts = [x if i % 2 else re.sub("\\s+", " ", x) for i, x in enumerate(parts)]
+    return re.sub("\\s*;\\s*$", "", "".join(parts)).strip()
+
+
+def _hash_text(x: str):
+    return hashlib.sha256(x.encode("utf-8")).hexdigest()
+
+
+## Bytes per row of a DataFrame from a sample (deep, so the strings count)
+def _row_bytes(dataframe, sample: int = 1000):
+    head = dataframe.iloc[:sample]
+    if head.shape[0] == 0:
+        return 0.0
+    return head.memory_usage(index=False, deep=True).sum() / head.shape[0]
+
+
+## Statement timings: every statement (and `span`) gets one record with its
+## connect, execute, and fetch seconds.  Records are kept when `profile` is
+## on, passed to the hooks, and logged at DEBUG; with none of those the
+## timers are the only cost.  `span_id`/`parent_id` nest the records the way
+## tracing spans do.
+_TIMING_COLUMNS = [
+    "started",
+    "operation",
+    "span",
+    "span_id",
+    "parent_id",
+    "fingerprint",
+    "statement",
+    "connect_seconds",
+    "execute_seconds",
+    "fetch_seconds",
+    "seconds",
+    "rows",
+    "bytes",
+    "error",
+]
+
+
+class _Profiler:
+    def __init__(self, enabled: bool = False, size: int = 100000):
+        self.enabled = enabled
+        self.hooks = []
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def active(self):
+        return self.enabled or len(self.hooks) > 0 or logger.isEnabledFor(logging.DEBUG)
+
+    def stack(self):
+        ## The open spans of this thread (upload workers share the caller's)
+        if getattr(self.local, "spans", None) is None:
+            self.local.spans = []
+        return self.local.spans
+
+    @contextmanager
+    def span(self, name: str):
+
+        if not self.active():
+            yield None
+            return
+
+        timing = _Timing(self, "span", name)
+        stack = self.stack()
+        stack.append({"name": name, "span_id": timing.span_id})
+        try:
+            yield timing.span_id
+        except BaseException as e:
+            timing.error = e
+            raise
+        finally:
+            stack.pop()
+            timing.finish()
+
+    def record(self, timing):
+
+        stack = self.stack()
+        parent = stack[-1] if stack else {"name": None, "span_id": None}
+        statement = _normalize_sql(str(timing.statement))
+
+        record = dict(
+            zip(
+                _TIMING_COLUMNS,
+                [
+                    timing.started,
+                    timing.operation,
+                    parent["name"],
+                    timing.span_id,
+                    parent["span_id"],
+                    _hash_text(statement)[:16],
+                    statement[:200],
+                    timing.seconds["connect"],
+                    timing.seconds["execute"],
+                    timing.seconds["fetch"],
+                    perf_counter() - timing.begin,
+                    timing.rows,
+                    timing.bytes,
+                    None if timing.error is None else repr(timing.error),
+                ],
+            )
+        )
+
+        if self.enabled:
+            with self.lock:
+                self.records.append(record)
+
+        logger.debug(
+            "%s %s: %.3f seconds (connect %.3f, execute %.3f, fetch %.3f), %s rows, %s bytes%s",
+            record["operation"],
+            record["fingerprint"],
+            record["seconds"],
+            record["connect_seconds"],
+            record["execute_seconds"],
+            record["fetch_seconds"],
+            record["rows"],
+            record["bytes"],
+            "" if record["error"] is None else ", failed: " + record["error"],
+        )
+
+        for hook in list(self.hooks):
+            try:
+                hook(record)
+            except Exception as e:
+                warnings.warn("A profiling hook failed: {}".format(e))
+
+    def frame(self):
+        with self.lock:
+            return pd.DataFrame(list(self.records), columns=_TIMING_COLUMNS)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+
+class _Timing:
+    def __init__(self, profiler, operation: str, statement: str):
+
+        self.profiler = profiler if profiler.active() else None
+        self.operation = operation
+        self.statement = statement
+        self.seconds = {"connect": 0.0, "execute": 0.0, "fetch": 0.0}
+        self.rows = None
+        self.bytes = None
+        self.error = None
+        self.begin = self.clock = perf_counter()
+
+        if self.profiler is not None:
+            self.started = datetime.datetime.now()
+            self.span_id = uuid.uuid4().hex[:16]
+
+    def mark(self, phase: str = None):
+        ## Charge the time since the last mark to `phase` (None restarts)
+        now = perf_counter()
+        if phase is not None:
+            self.seconds[phase] += now - self.clock
+        self.clock = now
+
+    def add(self, dataframe):
+        self.rows = (self.rows or 0) + dataframe.shape[0]
+        self.bytes = (self.bytes or 0) + _row_bytes(dataframe) * dataframe.shape[0]
+
+    def finish(self, dataframe=None):
+        if self.profiler is None:
+            return
+        if dataframe is not None:
+            self.add(dataframe)
+        self.profiler.record(self)
+
+
+## Time the fetch of each page of an iter_query
+def _timed_pages(pages, timing):
+    try:
+        while True:
+            timing.mark()
+            page = next(pages, None)
+            if page is None:
+                return
+            timing.mark("fetch")
+            timing.add(page)
+            yield page
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        timing.error = e
+        raise
+    finally:
+        pages.close()
+        timing.finish()
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+## A bounded, thread safe pool of pyodbc connections
+class _ConnectionPool:
+    def __init__(
+        self,
+        connect,
+        size: int = 4,
+        idle_timeout: float = 600,
+        ping_after: float = 60,
+        ping=None,
+    ):
+        self._connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self._ping = ping
+
+        self._idle = []
+        self._in_use = 0
+        self._generation = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        with self.checkout(timeout=timeout) as entry:
+            yield entry.connection
+
+    @contextmanager
+    def checkout(self, timeout: float = None):
+        entry = self.acquire(timeout=timeout)
+        try:
+            yield entry
+        except BaseException:
+            self.release(entry, failed=True)
+            raise
+        else:
+            self.release(entry)
+
+    def acquire(self, timeout: float = None):
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise Exception("The connection has been closed")
+
+                self._evict()
+
+                if len(self._idle) > 0:
+                    # most recently used first; it is the most likely to be alive
+                    entry = self._idle.pop()
+                    self._in_use += 1
+                    break
+
+                if self._in_use < self.size:
+                    entry = None
+                    self._in_use += 1
+                    generation = self._generation
+                    break
+
+                if not self._condition.wait(timeout):
+                    raise Exception(
+                        "Timed out waiting for one of the {} pooled connections".format(
+                            self.size
+                        )
+                    )
+
+        if (entry is not None) and (not self._alive(entry)):
+            _close_quietly(entry.connection)
+            generation = entry.generation
+            entry = None
+
+        if entry is None:
+            try:
+                entry = _PoolEntry(self._connect(), generation)
+            except BaseException:
+                with self._condition:
+                    self._in_use -= 1
+                    self._condition.notify()
+                raise
+
+        return entry
+
+    def release(self, entry, failed: bool = False):
+
+        entry.last_used = time()
+        keep = True
+
+        ## Clear any half finished transaction; a connection that can not
+        ## roll back is not worth keeping
+        if failed:
+            try:
+                entry.connection.rollback()
+            except Exception:
+                keep = False
+
+        with self._condition:
+            self._in_use -= 1
+            if self._closed or (entry.generation != self._generation):
+                keep = False
+            if keep:
+                self._idle.append(entry)
+            self._condition.notify()
+
+        if not keep:
+            _close_quietly(entry.connection)
+
+    def refresh(self):
+        ## Retire every connection made before now (e.g., with an expired token)
+        with self._condition:
+            self._generation += 1
+            stale, self._idle = self._idle, []
+        for entry in stale:
+            _close_quietly(entry.connection)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            stale, self._idle = self._idle, []
+            self._condition.notify_all()
+        for entry in stale:
+            _close_quietly(entry.connection)
+
+    def _evict(self):
+        ## Close spare connections that have sat unused too long, but always
+        ## keep the most recent one (reconnecting can mean another MFA prompt)
+        now = time()
+        keep = [
+            x
+            for i, x in enumerate(self._idle)
+            if (i == len(self._idle) - 1) or (now - x.last_used <= self.idle_timeout)
+        ]
+        stale = [x for x in self._idle if x not in keep]
+        self._idle = keep
+        for entry in stale:
+            _close_quietly(entry.connection)
+
+    def _alive(self, entry):
+        if getattr(entry.connection, "closed", False):
+            return False
+
+        ## Only pay for a round trip when the connection has been idle a while
+        if (self._ping is None) or (time() - entry.last_used < self.ping_after):
+            return True
+
+        try:
+            self._ping(entry.connection)
+            return True
+        except Exception:
+            return False
+
+
+class _PoolEntry:
+    def __init__(self, connection, generation: int):
+        self.connection = connection
+        self.generation = generation
+        self.last_used = time()
+        self.statements = _StatementCache()
+
+
+## Keeps one open cursor per parameterized statement on a connection.  pyodbc
+## only calls SQLPrepare when a cursor is handed different sql text than it
+## last ran, so reusing the cursor reuses the server's prepared plan.
+class _StatementCache:
+    def __init__(self, size: int = 32):
+        self.size = size
+        self._cursors = OrderedDict()
+
+    def cursor(self, connection, query: str):
+        cursor = self._cursors.pop(query, None)
+        if cursor is None:
+            cursor = connection.cursor()
+        self._cursors[query] = cursor
+
+        while len(self._cursors) > self.size:
+            _close_quietly(self._cursors.popitem(last=False)[1])
+
+        return cursor
+
+    def discard(self, query: str):
+        cursor = self._cursors.pop(query, None)
+        if cursor is not None:
+            _close_quietly(cursor)
+
+
+def _execute(cursor, query: str, params: list = None):
+    if params is None:
+        return cursor.execute(query)
+    else:
+        return cursor.execute(query, list(params))
+
+
+def _ping(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT 1").fetchall()
+    finally:
+        cursor.close()
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class _Hidden_Password_String(str):
+    def __init__(self, x):
+        self.x = x
+
+    def __repr__(self):
+        return re.sub(
+            r"(^.+?PWD=)(.+?)(;AUTHENTICATION=.+$)", r"\g<1>*****\g<3>", self.x
+        )
+
+
+## Helpers to stream query results page by page
+def _fetch_pages(cursor, chunksize: int, engine: str = "pandas", release=None):
+
+    columns = [x[0] for x in cursor.description]
+    type_codes = [x[1] for x in cursor.description]
+
+    def make_frame(rows):
+        if engine == "columnar":
+            return _columns_to_frame(_rows_to_columns(rows, type_codes), columns)
+        return _rows_to_frame(rows, columns)
+
+    try:
+        empty = True
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            empty = False
+            yield make_frame(rows)
+
+        ## Always hand back at least one (empty) frame so the columns are known
+        if empty:
+            yield make_frame([])
+    finally:
+        cursor.close()
+        if release is not None:
+            release()
+
+
+def _prepend(first, pages):
+    yield first
+    yield from pages
+
+
+def _rows_to_frame(rows, columns):
+    # mirrors how pd.read_sql_query builds a frame from a DBAPI cursor
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def _check_engine(engine):
+    if engine not in ["pandas", "columnar"]:
+        raise Exception("`engine` must be one of 'pandas' or 'columnar'")
+
+
+## Helpers for the columnar fetch engine
+## pyodbc reports each column's Python type in `cursor.description`; use it to
+## pick the numpy buffer up front rather than letting pandas infer it per cell
+_COLUMNAR_DTYPES = {
+    int: "int64",
+    float: "float64",
+    decimal.Decimal: "float64",
+    bool: "bool",
+    datetime.datetime: "datetime64[us]",
+    datetime.date: "datetime64[us]",
+}
+
+
+def _fetch_columnar(cursor, page_size: int = 50000):
+
+    columns = [x[0] for x in cursor.description]
+    type_codes = [x[1] for x in cursor.description]
+    pages = [[] for i in columns]
+
+    while True:
+        rows = cursor.fetchmany(page_size)
+        if not rows:
+            break
+        for buffer, array in zip(pages, _rows_to_columns(rows, type_codes)):
+            buffer.append(array)
+
+    arrays = []
+    for buffer, type_code in zip(pages, type_codes):
+        if len(buffer) == 0:
+            arrays.append(_column_to_array([], 0, type_code))
+        elif len(buffer) == 1:
+            arrays.append(buffer[0])
+        else:
+            arrays.append(np.concatenate(buffer))
+
+    return _columns_to_frame(arrays, columns)
+
+
+def _rows_to_columns(rows, type_codes):
+    return [_column_to_array(rows, j, x) for j, x in enumerate(type_codes)]
+
+
+def _column_to_array(rows, j, type_code):
+
+    dtype = _COLUMNAR_DTYPES.get(type_code)
+    take = itemgetter(j)
+
+    ## Numeric columns go straight from the rows into a typed buffer; a NULL
+    ## (None) raises and drops through to the slower paths below
+    if dtype == "int64":
+        try:
+            return np.fromiter(map(take, rows), dtype=dtype, count=len(rows))
+        except TypeError:
+            # int columns with NULLs become float (as pandas does)
+            dtype = "float64"
+    elif dtype == "float64":
+        try:
+            return np.fromiter(
+                map(float, map(take, rows)), dtype=dtype, count=len(rows)
+            )
+        except TypeError:
+            pass
+
+    out = np.empty(len(rows), dtype=object)
+    out[:] = list(map(take, rows))
+
+    if dtype == "float64":
+        return out.astype(dtype)
+    elif dtype == "bool":
+        return out if None in out else out.astype(dtype)
+    elif dtype == "datetime64[us]":
+        try:
+            return pd.to_datetime(out).to_numpy()
+        except (TypeError, ValueError):
+            # e.g., dates beyond the range pandas can represent
+            return out
+
+    return out
+
+
+def _columns_to_frame(arrays, columns):
+    out = pd.DataFrame(dict(enumerate(arrays)), copy=False)
+    out.columns = columns
+    return out
+
+
+## Draw `n` unique row numbers (1 based, sorted) out of `size` without a loop
+def _sample_rows(n: int, size: int, seed: int = None):
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(int(size), size=int(n), replace=False)) + 1
+
+
+## Helper function to make tables
+def _make_sql_table_query(
+    dataframe,
+    name: str = "@mytable",
+    break_length: int = 1000,
+    command: str = "DECLARE",
+    command2: str = "TABLE",
+    additional: str = "",
+    nullable: list = [True],
+    types: str = "legacy",
+    dtypes: dict = None,
+):
+
+    return "".join(
+        _iter_sql_table_query(
+            dataframe,
+            name=name,
+            break_length=break_length,
+            command=command,
+            command2=command2,
+            additional=additional,
+            nullable=nullable,
+            types=types,
+            dtypes=dtypes,
+        )
+    )
+
+
+## The script as chunks: the declaration, then the insert statements for
+## `block_rows` rows (rounded to whole statements) at a time, so only one
+## block is ever rendered in memory
+def _iter_sql_table_query(
+    dataframe,
+    name: str = "@mytable",
+    break_length: int = 1000,
+    command: str = "DECLARE",
+    command2: str = "TABLE",
+    additional: str = "",
+    nullable: list = [True],
+    block_rows: int = 100000,
+    types: str = "legacy",
+    dtypes: dict = None,
+):
+
+    if not isinstance(dataframe, pd.DataFrame):
+        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+
+    dec_table = _make_sql_schema_query(
+        dataframe=dataframe,
+        name=name,
+        command=command,
+        command2=command2,
+        additional=additional,
+        nullable=nullable,
+        types=types,
+        dtypes=dtypes,
+    )
+
+    yield "\n".join([dec_table, " ", ""])
+
+    step = break_length * max(1, block_rows // break_length)
+    for s in range(0, max(dataframe.shape[0], 1), step):
+        tab = _make_sql_table_rows_query(
+            dataframe=dataframe.iloc[s : s + step],
+            name=name,
+            break_length=break_length,
+        )
+        yield tab + "\n"
+
+
+## Returns the script as a string, or writes it chunk by chunk to `file` (a
+## path or an open, writable file-like object)
+def _write_sql_table_query(file, dataframe, **kwargs):
+
+    chunks = _iter_sql_table_query(dataframe, **kwargs)
+
+    if file is None:
+        return "".join(chunks)
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "w", encoding="utf-8") as f:
+            f.writelines(chunks)
+    else:
+        file.writelines(chunks)
+
+
+def _make_sql_schema_query(
+    dataframe,
+    name: str = "@mytable",
+    command: str = "DECLARE",
+    command2: str = "TABLE ",
+    additional: str = "",
+    nullable: list = [True],
+    types: str = "legacy",
+    dtypes: dict = None,
+):
+
+    if not isinstance(dataframe, pd.DataFrame):
+        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+
+    if types not in _SQL_TYPERS:
+        raise Exception("`types` must be one of 'legacy' or 'narrow'")
+
+    ## Make the type declaration (the schema); `dtypes` overrides by column
+    dtypes = {} if dtypes is None else dtypes
+    typer = _SQL_TYPERS[types]
+    types = [
+        dtypes[x] if x in dtypes else typer(dataframe.iloc[:, j])
+        for j, x in enumerate(dataframe.columns)
+    ]
+
+    if additional != "":
+        "\n" + additional
+
+    if len(nullable) == 1:
+        nullable = [nullable[0] for i in range(len(types))]
+
+    nn = []
+    for i in range(len(nullable)):
+        if nullable[i]:
+            nn.append("")
+        else:
+            nn.append(" NOT NULL")
+
+    nullable = nn
+
+    dec_table = "{} {} {}(\n{}{}\n)".format(
+        command,
+        name,
+        command2,
+        ",\n".join(
+            [
+                "    [{}] {}{}".format(x, y, z)
+                for x, y, z in zip(dataframe.columns, types, nullable)
+            ]
+        ),
+        additional,
+    )
+
+    return dec_table
+
+
+## One pass over the columns; only the text columns are measured (the
+## longest value plus 200 characters of head room)
+def _sql_type(col):
+
+    dtype = str(col.dtype)
+
+    if dtype in ["float64", "float32"]:
+        return "NUMERIC(32, 5)"
+    elif dtype == "int64" and col.shape[0] > 0:
+        ## INT overflows beyond 32 bits
+        fits = -(2**31) <= col.min() and col.max() < 2**31
+        return "INT" if fits else "BIGINT"
+    elif dtype in ["int32", "int64", "bool"]:
+        return "INT"
+    elif dtype == "datetime64" or re.match("^datetime64\\[[mun]?s\\]$", dtype):
+        return "DATETIME"
+
+    width = _max_text_length(col) + 200
+
+    return "VARCHAR({})".format(width if width < 7000 else "Max")
+
+
+## The narrowest type that holds every value, from one statistics pass per
+## column
+def _narrow_sql_type(col):
+
+    kind = col.dtype.kind
+    tz = getattr(col.dtype, "tz", None)
+    values = col.dropna()
+
+    if kind == "b":
+        return "BIT"
+    elif kind in "iu":
+        return _int_sql_type(values)
+    elif kind == "f":
+        precision = "float32" if col.dtype == "float32" else "float64"
+        return _decimal_sql_type(values.to_numpy(dtype=precision), col.dtype)
+    elif kind == "M" and tz is None:
+        return _datetime_sql_type(values)
+
+    ## Text: NVARCHAR only when there are characters outside ASCII
+    if col.dtype.name == "category":
+        values = col.cat.categories.to_series()
+    values = _text_values(values)
+
+    width = max(_max_text_length(values), 1)
+    if values.str.contains("[^\\x00-\\x7f]", regex=True, na=False).any():
+        return "NVARCHAR({})".format(width if width <= 4000 else "MAX")
+
+    return "VARCHAR({})".format(width if width <= 8000 else "MAX")
+
+
+def _int_sql_type(values):
+
+    if values.shape[0] == 0:
+        return "INT"
+
+    low, high = int(values.min()), int(values.max())
+
+    for sql, (lowest, highest) in [
+        ("TINYINT", (0, 255)),
+        ("SMALLINT", (-(2**15), 2**15 - 1)),
+        ("INT", (-(2**31), 2**31 - 1)),
+        ("BIGINT", (-(2**63), 2**63 - 1)),
+    ]:
+        if lowest <= low and high <= highest:
+            return sql
+
+    return "DECIMAL({}, 0)".format(max(len(str(abs(low))), len(str(abs(high)))))
+
+
+def _decimal_sql_type(values, dtype):
+
+    values = values[np.isfinite(values)]
+    if values.shape[0] == 0:
+        return "FLOAT"
+
+    ## The fewest decimal places that reproduce every value exactly, at the
+    ## column's own precision (float32 holds about 7 significant digits)
+    significant = 7 if dtype == "float32" else 38
+    for scale in range(0, 16):
+        if np.array_equal(np.round(values, scale), values):
+            break
+    else:
+        return "REAL" if dtype == "float32" else "FLOAT"
+
+    digits = len(str(int(np.abs(values).max())))
+    precision = digits + scale
+    if precision > significant:
+        return "REAL" if dtype == "float32" else "FLOAT"
+
+    return "DECIMAL({}, {})".format(precision, scale)
+
+
+def _datetime_sql_type(values):
+
+    if values.shape[0] == 0:
+        return "DATETIME2(0)"
+
+    array = values.to_numpy()
+    per_second = {"s": 1, "ms": 10**3, "us": 10**6, "ns": 10**9}[
+        np.datetime_data(array.dtype)[0]
+    ]
+
+    ## Ticks since midnight
+    ticks = array.view("int64") % (86400 * per_second)
+    if not ticks.any():
+        return "DATE"
+
+    ## The fractional second digits actually used
+    fraction = ticks % per_second
+    for precision in [0, 3, 6]:
+        step = per_second // 10**precision
+        if step >= 1 and not (fraction % step).any():
+            return "DATETIME2({})".format(precision)
+
+    return "DATETIME2(7)"
+
+
+_SQL_TYPERS = {"legacy": _sql_type, "narrow": _narrow_sql_type}
+
+
+def _max_text_length(col):
+
+    if col.dtype.name == "category":
+        values = col.cat.categories.to_series()
+    else:
+        values = col
+
+    if values.dtype.kind == "O" or pd.api.types.is_string_dtype(values.dtype):
+        lengths = _text_values(values).str.len()
+    else:
+        lengths = values[values.notna()].astype(str).str.len()
+
+    out = lengths.max()
+
+    return 0 if pd.isnull(out) else int(out)
+
+
+## Object columns that aren't all strings (e.g., the dates, Decimals, or ints
+## pyodbc returns) are measured and checked as their str()
+def _text_values(values):
+    if pd.api.types.infer_dtype(values, skipna=True) in ["string", "empty"]:
+        return values
+    return values.map(str, na_action="ignore")
+
+
+def _make_sql_table_rows_query(dataframe, name: str, break_length: int = 1000):
+
+    if not isinstance(dataframe, pd.DataFrame):
+        raise Exception("`dataframe` does not appear to be a Pandas DataFrame")
+
+    if dataframe.shape[1] == 0:
+        return ""
+
+    ## Render whole columns at once, then glue the columns into rows
+    columns = [_sql_literals(dataframe.iloc[:, j]) for j in range(dataframe.shape[1])]
+    rows = ["(" + ", ".join(x) + ")" for x in zip(*columns)]
+
+    ## A new insert statement every `break_length` rows
+    insert = "insert into [{}] values\n".format(name)
+
+    return "\n".join(
+        [
+            insert + ",\n".join(rows[i : i + break_length])
+            for i in range(0, len(rows), break_length)
+        ]
+    )
+
+
+## A column as quoted (and escaped) tsql literals, rendered as str() shows
+## each value: ints without a trailing decimal, bools as 0/1, datetimes
+## with microseconds only when there are some, and missing values as NULL
+def _sql_literals(col):
+
+    kind = col.dtype.kind
+
+    if not isinstance(col.dtype, np.dtype) or kind not in "biufM":
+        ## Text (the only values that need escaping) and everything else
+        return [
+            "NULL" if x is None else "'" + str(x).replace("'", "''") + "'"
+            for x in _upload_column(col)
+        ]
+
+    values = col.to_numpy()
+
+    if kind == "b":
+        return np.where(values, "'1'", "'0'").tolist()
+    elif kind in "iu":
+        return ["'" + x + "'" for x in map(str, values.tolist())]
+    elif kind == "f":
+        out = ["'" + x + "'" for x in map(repr, values.tolist())]
+        missing = np.isnan(values)
+    else:
+        text = np.datetime_as_string(values, unit="s")
+        micro = values.astype("datetime64[us]").view("int64") % 1000000 != 0
+        if micro.any():
+            text = text.astype(object)
+            text[micro] = np.datetime_as_string(values[micro], unit="us")
+        out = ["'" + x[:10] + " " + x[11:] + "'" for x in text.tolist()]
+        missing = np.isnat(values)
+
+    for i in np.flatnonzero(missing):
+        out[i] = "NULL"
+
+    return out
+
+
+## Helpers to get a token rom Azure's CLI for use in the connection string
+class _DataBaseCredentialWrapper:
+    def __init__(
+        self,
+        resource="https://database.windows.net/",
+        tenant: str = None,
+        tenantid: str = None,
+    ):
+        self.resource = resource
+
+        if tenantid is None:
+            tenantidi = ""
+        else:
+            tenantidi = "--tenant " + tenantid
+
+        try:
+            result = subprocess.check_output("az account show", shell=True)
+        except Exception as e:
+            result = ""
+
+        if result != "":
+            # if (json.loads(result).get('tenantId') != tenantid) and (tenantid is not None):
+            #    os.system('az logout')
+            az_tenant = re.sub(
+                "^.+@|\\.com$", "", json.loads(result).get("user").get("name")
+            ).lower()
+            if tenant != az_tenant:
+                os.system("az logout")
+
+        self.cred = AzureCliCredential()
+
+        try:
+            self.cli_token = self.cred.get_token(self.resource)
+        except Exception as e:
             if tenant is not None:
                 print(
                     "Logging into Azure CLI...\nUse your '{}' credentials.".format(
@@ -1129,15 +3994,211 @@ class _DataBaseCredentialWrapper:
             self.cli_token = self.cred.get_token(self.resource)
 
 
+## Shares one token per tenant across ConnectDatabase objects (and, through a
+## private cache file, across processes) and refreshes it before it expires
+class _TokenManager:
+    def __init__(
+        self,
+        tenant: str = None,
+        tenantid: str = None,
+        resource: str = "https://database.windows.net/",
+        path: str = None,
+        lead: float = 600,
+    ):
+        self.tenant = tenant
+        self.tenantid = tenantid
+        self.resource = resource
+        self.path = path if path is not None else _token_cache_path()
+        self.key = "|".join([resource, str(tenant), str(tenantid)])
+        self.lead = lead
+
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._stop = threading.Event()
+
+        self.token = self._read_cache()
+        if self.token is None:
+            self.token = self._fetch(interactive=True)
+
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="ds-token-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def get(self):
+        ## The current token; fetched again (logging in if need be) when it is
+        ## about to expire and no other process has refreshed it already
+        with self._lock:
+            if _token_expiring(self.token, 100):
+                token = self._read_cache()
+                if token is None:
+                    token = self._fetch(interactive=True)
+                self.token = token
+            token = self.token
+
+        self._publish(token)
+        return token
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(weakref.WeakMethod(callback))
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+
+        while True:
+            wait = self.token.cli_token.expires_on - self.lead - time()
+            if self._stop.wait(max(wait, 30)):
+                return
+
+            try:
+                with self._lock:
+                    token = self._read_cache()
+                    if (token is None) or _token_expiring(token, self.lead):
+                        token = self._fetch(interactive=False)
+                    self.token = token
+            except Exception:
+                ## Leave it to the next foreground call, which can log in
+                continue
+
+            self._publish(token)
+
+    def _publish(self, token):
+
+        with self._lock:
+            self._subscribers = [x for x in self._subscribers if x() is not None]
+            callbacks = [x() for x in self._subscribers]
+
+        for callback in callbacks:
+            if callback is not None:
+                callback(token)
+
+    def _fetch(self, interactive: bool = True):
+
+        if interactive:
+            wrapper = _DataBaseCredentialWrapper(
+                resource=self.resource, tenant=self.tenant, tenantid=self.tenantid
+            )
+            cli_token = wrapper.cli_token
+        else:
+            ## No logout/login from a background thread; the CLI refreshes
+            ## silently (for this tenant, whatever account is active)
+            if self.tenantid is None:
+                credential = AzureCliCredential()
+            else:
+                credential = AzureCliCredential(tenant_id=self.tenantid)
+            cli_token = credential.get_token(self.resource)
+
+        ## Never cache (and so share) a token issued for another tenant
+        found = _token_tenant(cli_token.token)
+        if (self.tenantid is not None) and (found != self.tenantid):
+            raise Exception(
+                "The Azure CLI returned a token for tenant `{}` rather than `{}`".format(
+                    found, self.tenantid
+                )
+            )
+
+        token = _CachedToken(
+            AccessToken(cli_token.token, int(cli_token.expires_on)), self.resource
+        )
+        self._write_cache(token)
+        return token
+
+    def _read_cache(self):
+
+        try:
+            with open(self.path, "r") as stream:
+                found = json.load(stream).get(self.key)
+        except (OSError, ValueError, AttributeError):
+            return None
+
+        if found is None:
+            return None
+
+        token = _CachedToken(
+            AccessToken(found["token"], int(found["expires_on"])), self.resource
+        )
+
+        return None if _token_expiring(token, 100) else token
+
+    def _write_cache(self, token):
+
+        try:
+            try:
+                with open(self.path, "r") as stream:
+                    cache = json.load(stream)
+            except (OSError, ValueError):
+                cache = {}
+
+            cache = {
+                k: v
+                for k, v in cache.items()
+                if isinstance(v, dict) and (v.get("expires_on", 0) > time())
+            }
+            cache[self.key] = {
+                "token": token.cli_token.token,
+                "expires_on": token.cli_token.expires_on,
+            }
+
+            ## Write privately then swap in so readers never see a partial file
+            temp = "{}.{}.{}.tmp".format(self.path, os.getpid(), threading.get_ident())
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as stream:
+                json.dump(cache, stream)
+            os.replace(temp, self.path)
+        except OSError:
+            warnings.warn("Could not write the token cache to '{}'".format(self.path))
+
+
+class _CachedToken:
+    def __init__(self, cli_token, resource: str = "https://database.windows.net/"):
+        self.cli_token = cli_token
+        self.resource = resource
+
+
+_TOKEN_MANAGERS = {}
+_TOKEN_MANAGERS_LOCK = threading.Lock()
+
+
+def _get_token_manager(tenant: str = None, tenantid: str = None):
+    with _TOKEN_MANAGERS_LOCK:
+        key = (tenant, tenantid)
+        if key not in _TOKEN_MANAGERS:
+            _TOKEN_MANAGERS[key] = _TokenManager(tenant=tenant, tenantid=tenantid)
+        return _TOKEN_MANAGERS[key]
+
+
+def _token_cache_path():
+    return os.path.join(os.path.expanduser("~"), ".ds_token_cache.json")
+
+
+## The tenant (`tid` claim) a JWT access token was issued for
+def _token_tenant(token: str):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("tid")
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+def _token_expiring(token, margin: float = 100):
+    return time() > token.cli_token.expires_on - margin
+
+
 def _prepare_token(token):
 
     # get bytes from token obtained
     tokenb = bytes(token.cli_token[0], "UTF-8")
 
-    exptoken = b""
-    for i in tokenb:
-        exptoken += bytes({i})
-        exptoken += bytes(1)
+    ## Follow every byte with a zero byte in one slice assignment
+    exptoken = bytearray(2 * len(tokenb))
+    exptoken[::2] = tokenb
 
-    tokenstruct = struct.pack("=i", len(exptoken)) + exptoken
+    tokenstruct = struct.pack("=i", len(exptoken)) + bytes(exptoken)
     return tokenstruct
+
+
+SQL_COPT_SS_ACCESS_TOKEN = 1256
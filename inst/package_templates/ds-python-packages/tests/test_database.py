@@ -0,0 +1,747 @@
+import asyncio
+import base64
+import datetime
+import decimal
+import json
+import sqlite3
+import threading
+
+import pandas as pd
+import numpy as np
+import pytest
+
+from ds.connect.async_database import AsyncConnectDatabase
+from ds.connect import database
+from ds.connect.database import (
+    ConnectDatabase,
+    ExecuteManyBackend,
+    LocalEngineBackend,
+    _CatalogCache,
+    _ConnectionPool,
+    _QueryCache,
+    _UploadCheckpoint,
+    _UploadSource,
+    _TokenManager,
+    _BatchSizer,
+    _Profiler,
+    _Timing,
+    _make_sql_design_queries,
+    _make_sql_schema_query,
+    _make_sql_table_query,
+    _column_to_array,
+    _delimited_text,
+    _fetch_pages,
+    _insert_query,
+    _merge_query,
+    _repage,
+    _sample_rows,
+    _upload_rows,
+    _watermark_dump,
+    _watermark_load,
+    _watermark_mask,
+)
+
+
+def offline_db(tmp_path, pool_size: int = 2):
+    ## A ConnectDatabase over a shared in memory SQLite database (no server)
+    path = "file:{}?mode=memory&cache=shared".format(tmp_path.name)
+    keep = sqlite3.connect(path, uri=True)
+    db = ConnectDatabase.__new__(ConnectDatabase)
+    db.credentials = {"Path": path, "SourceType": "Local Database"}
+    db.connection_type = "Local Database"
+    db._token_lock = threading.Lock()
+    db._local = threading.local()
+    db._direct_lock = threading.Lock()
+    db._direct, db._direct_cursor = None, None
+    db._new_connection = lambda: sqlite3.connect(
+        path, uri=True, check_same_thread=False
+    )
+    db._catalog = _CatalogCache(ttl=300)
+    db._query_cache = _QueryCache(directory=str(tmp_path / "cache"))
+    db._profiler = _Profiler()
+    db._pool = _ConnectionPool(db._new_connection, size=pool_size)
+    db._keep = keep
+    return db
+
+
+class FailingBackend(LocalEngineBackend):
+    ## Loads `fail_after` batches and then fails
+    def __init__(self, connection, fail_after: int):
+        super().__init__(connection)
+        self.fail_after = fail_after
+
+    def load(self, cursor, name, batch):
+        if self.fail_after == 0:
+            raise RuntimeError("load failed")
+        self.fail_after -= 1
+        return super().load(cursor, name, batch)
+
+
+class ServerBackend(ExecuteManyBackend):
+    ## The server loader's path over the SQLite pool; fails its first `fail` loads
+    def __init__(self, fail: int = 0):
+        super().__init__()
+        self.fail = fail
+
+    def load(self, cursor, name, batch):
+        if self.fail > 0:
+            self.fail -= 1
+            raise RuntimeError("load failed")
+        cursor.executemany(_insert_query(name, batch[0]), batch[1])
+        return cursor.rowcount
+
+
+def server_db(tmp_path, monkeypatch):
+    ## offline_db with the catalog lookups write_table makes on a server
+    db = offline_db(tmp_path)
+    db._has_permission = lambda operation="CREATE TABLE": True
+    db.tables = lambda to_list=False: [
+        x[0] for x in db._keep.execute("SELECT name FROM sqlite_master")
+    ]
+    db.get = lambda name, n=None: db.query("SELECT * FROM {} LIMIT 1".format(name))
+    db._row_count = lambda name, metadata=False: db._keep.execute(
+        "SELECT COUNT(*) FROM {}".format(name)
+    ).fetchone()[0]
+    monkeypatch.setattr(
+        database,
+        "_UploadCheckpoint",
+        lambda run, upload_id, name, remote: _UploadCheckpoint(
+            run, upload_id, name, remote=False
+        ),
+    )
+    return db
+
+
+def make_frame():
+    return pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "name": ["a", "it's", None],
+            "score": [1.5, np.nan, 2.0],
+            "flag": [True, False, True],
+        }
+    )
+
+
+def test_schema_query_types():
+    out = _make_sql_schema_query(make_frame(), name="@x")
+    assert "[id] INT" in out
+    assert "[name] VARCHAR(204)" in out
+    assert "[score] NUMERIC(32, 5)" in out
+    assert "[flag] INT" in out
+
+
+def test_schema_query_does_not_mutate():
+    df = make_frame()
+    before = df.copy()
+    _make_sql_table_query(df, name="@x")
+    pd.testing.assert_frame_equal(df, before)
+
+
+def test_table_query_escapes_and_nulls():
+    out = _make_sql_table_query(make_frame(), name="@x")
+    assert "('2', 'it''s', NULL, '0')" in out
+
+
+def test_table_query_breaks_every_break_length_rows():
+    out = _make_sql_table_query(
+        pd.DataFrame({"a": range(5)}), name="@x", break_length=2
+    )
+    assert out.count("insert into [@x] values") == 3
+    assert out.rstrip().endswith("('4')")
+
+
+def test_schema_query_sizes_object_columns_of_other_values():
+    ## e.g., the dates, Decimals, and ints pyodbc returns in object columns
+    df = pd.DataFrame(
+        {
+            "day": pd.Series([datetime.date(2024, 1, 2), None], dtype=object),
+            "n": pd.Series([5, 12345], dtype=object),
+            "amount": pd.Series([decimal.Decimal("1.50"), None], dtype=object),
+        }
+    )
+    out = _make_sql_schema_query(df, name="@x")
+    assert "[day] VARCHAR(210)" in out
+    assert "[n] VARCHAR(205)" in out
+    assert "[amount] VARCHAR(204)" in out
+
+
+def test_schema_query_narrow_types():
+    df = pd.DataFrame(
+        {
+            "small": [0, 200],
+            "big": [0, 2**40],
+            "price": [1.25, 10.5],
+            "day": pd.to_datetime(["2020-01-01", "2020-01-02"]),
+            "name": ["ab", "abc"],
+            "word": ["café", "x"],
+        }
+    )
+    out = _make_sql_schema_query(
+        df, name="@x", types="narrow", dtypes={"name": "CHAR(3)"}
+    )
+    assert "[small] TINYINT" in out
+    assert "[big] BIGINT" in out
+    assert "[price] DECIMAL(4, 2)" in out
+    assert "[day] DATE" in out
+    assert "[name] CHAR(3)" in out
+    assert "[word] NVARCHAR(4)" in out
+
+
+def test_narrow_types_for_float32_and_object_columns():
+    df = pd.DataFrame(
+        {
+            "f": np.array([1.1, 2.2], dtype="float32"),
+            "pi": np.array([np.pi], dtype="float32").repeat(2),
+            "day": pd.Series([datetime.date(2024, 1, 2), None], dtype=object),
+            "n": pd.Series([5, 12345], dtype=object),
+        }
+    )
+    out = _make_sql_schema_query(df, name="@x", types="narrow")
+    assert "[f] DECIMAL(2, 1)" in out
+    assert "[pi] REAL" in out
+    assert "[day] VARCHAR(10)" in out
+    assert "[n] VARCHAR(5)" in out
+
+
+def test_merge_query():
+    out = _merge_query("t1", "s1", ["id", "name"], ["id"], delete_missing=True)
+    assert "ON t.[id] = s.[id]" in out
+    assert "UPDATE SET t.[name] = s.[name]" in out
+    assert "INSERT ([id], [name]) VALUES (s.[id], s.[name])" in out
+    assert out.endswith("WHEN NOT MATCHED BY SOURCE THEN DELETE;")
+    assert "UPDATE" not in _merge_query("t1", "s1", ["id"], ["id"])
+
+
+def test_merge_query_identity():
+    out = _merge_query("t1", "s1", ["id", "rid", "name"], ["rid"], identity=["id"])
+    assert "t.[name] = s.[name]" in out
+    assert "t.[id] = s.[id]" not in out
+    assert "INSERT ([id], [rid], [name])" in out
+
+
+def test_watermark_mask_and_round_trip():
+    ts = pd.Series(pd.to_datetime(["2020-01-01", "2020-01-03", None]))
+    mark = _watermark_load(_watermark_dump(pd.Timestamp("2020-01-02")))
+    assert _watermark_mask(ts, mark).tolist() == [False, True, False]
+    assert _watermark_mask(pd.Series([1, 5]), np.int64(2)).tolist() == [False, True]
+
+
+def test_design_queries_build_key_then_indexes():
+    out = _make_sql_design_queries(
+        "dbo.t", compression="page", clustered="id", indexes=["a", ["b", "c"]]
+    )
+    assert out[0] == (
+        "CREATE CLUSTERED INDEX [cx_dbo_t] ON dbo.t ([id]) WITH (DATA_COMPRESSION = PAGE)"
+    )
+    assert out[2].startswith(
+        "CREATE NONCLUSTERED INDEX [ix_dbo_t_b_c] ON dbo.t ([b], [c])"
+    )
+    assert _make_sql_design_queries("t") == []
+
+
+def test_batch_sizer_doubles_then_backs_off():
+    sizer = _BatchSizer(start=10000)
+    assert sizer.update(0, 10000, 1.0)[1] == 20000
+    assert sizer.update(1, 20000, 1.0)[1] == 40000
+    assert sizer.update(2, 40000, 60.0)[1] == 20000
+    assert sizer.update(3, 20000, 0.5)[1] == 30000
+    sizer.observe(pd.DataFrame({"x": ["a" * 10000] * 10}))
+    assert sizer() < 30000
+    assert list(sizer.decisions()["batch_size"]) == [20000, 40000, 20000, 30000]
+
+
+def test_profiler_nests_statements_in_spans():
+    profiler = _Profiler(enabled=True)
+    seen = []
+    profiler.hooks.append(seen.append)
+    with profiler.span("step"):
+        for query in ["SELECT  1", "SELECT 1;"]:
+            timing = _Timing(profiler, "query", query)
+            timing.mark("execute")
+            timing.finish(pd.DataFrame({"x": [1, 2]}))
+    out = profiler.frame()
+    assert list(out["operation"]) == ["query", "query", "span"]
+    assert out["fingerprint"][0] == out["fingerprint"][1]
+    assert list(out["rows"][:2]) == [2, 2]
+    assert (out["parent_id"][:2] == out["span_id"][2]).all()
+    assert len(seen) == 3
+
+
+def test_incremental_resume_reruns_the_rows_that_did_not_load(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    db = offline_db(tmp_path)
+    engine = sqlite3.connect(":memory:", check_same_thread=False)
+    df = pd.DataFrame({"id": range(10)})
+    kwargs = dict(
+        mode="incremental", watermark="id", resume=True, batch_size=2, verbose=False
+    )
+
+    with pytest.raises(RuntimeError):
+        db.write_table(df, "t", method=FailingBackend(engine, 3), **kwargs)
+    assert engine.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 6
+
+    db.write_table(df, "t", method=LocalEngineBackend(engine), **kwargs)
+    ids = [x[0] for x in engine.execute("SELECT id FROM t ORDER BY id")]
+    assert ids == list(range(10))
+    assert (
+        engine.execute("SELECT COUNT(*) FROM ds_upload_checkpoint").fetchone()[0] == 0
+    )
+    journal = tmp_path / ".ds_upload_journal"
+    assert [x.name for x in journal.iterdir()] == ["watermarks.json"]
+
+    ## The recorded mark now skips the lookup and the rows already sent
+    db.write_table(df, "t", method=LocalEngineBackend(engine), **kwargs)
+    assert engine.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 10
+
+
+def test_iterator_resume_needs_a_key(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    db = offline_db(tmp_path)
+    engine = sqlite3.connect(":memory:", check_same_thread=False)
+    monday = pd.DataFrame({"id": range(6)})
+    tuesday = pd.DataFrame({"id": range(100, 106)})
+    pages = lambda df: (df.iloc[i : i + 2] for i in range(0, 6, 2))
+
+    with pytest.raises(Exception, match="resume = 'key'"):
+        db.write_table(
+            pages(monday), "t", method=LocalEngineBackend(engine), resume=True
+        )
+
+    with pytest.raises(RuntimeError):
+        db.write_table(
+            pages(monday),
+            "t",
+            method=FailingBackend(engine, 2),
+            resume="monday",
+            batch_size=2,
+            verbose=False,
+        )
+
+    ## Other data under another key starts from its first batch
+    db.write_table(
+        pages(tuesday),
+        "t",
+        method=LocalEngineBackend(engine),
+        append=True,
+        resume="tuesday",
+        batch_size=2,
+        verbose=False,
+    )
+    ids = [x[0] for x in engine.execute("SELECT id FROM t WHERE id >= 100")]
+    assert ids == list(range(100, 106))
+
+
+def test_query_many_runs_on_the_pool_and_refuses_generators(tmp_path):
+    db = offline_db(tmp_path, pool_size=2)
+    db.query("CREATE TABLE a (x INT)", results=False)
+    db.query("INSERT INTO a VALUES (1), (2), (3)", results=False)
+
+    out = db.query_many(["SELECT * FROM a"] * 5)
+    assert [x.shape[0] for x in out] == [3] * 5
+
+    with pytest.raises(Exception, match="chunksize"):
+        db.query_many(["SELECT * FROM a"] * 3, chunksize=5)
+
+
+def test_async_iter_queries_past_the_pool_size_do_not_deadlock(tmp_path):
+    db = offline_db(tmp_path, pool_size=2)
+    db.query("CREATE TABLE a (x INT)", results=False)
+    db.query("INSERT INTO a VALUES (1), (2), (3), (4), (5)", results=False)
+    adb = AsyncConnectDatabase(database=db)
+
+    async def pull():
+        return [x.shape[0] async for x in adb.iter_query("SELECT * FROM a", 2)]
+
+    async def main():
+        return await asyncio.wait_for(asyncio.gather(*[pull() for i in range(4)]), 10)
+
+    assert asyncio.run(main()) == [[2, 2, 1]] * 4
+    adb._executor.shutdown()
+
+
+def test_async_query_takes_params_chunksize_and_cache(tmp_path):
+    db = offline_db(tmp_path)
+    db.query("CREATE TABLE a (x INT)", results=False)
+    db.query("INSERT INTO a VALUES (1), (2), (3)", results=False)
+    adb = AsyncConnectDatabase(database=db)
+
+    async def main():
+        found = await adb.query("SELECT * FROM a WHERE x > ?", params=[1])
+        cached = await adb.query("SELECT * FROM a", cache=True)
+        pages = await adb.query("SELECT * FROM a WHERE x < ?", chunksize=1, params=[3])
+        return found.shape[0], cached.shape[0], [x.shape[0] async for x in pages]
+
+    assert asyncio.run(main()) == (2, 3, [1, 1])
+    adb._executor.shutdown()
+
+
+class UncountedBackend(LocalEngineBackend):
+    ## A driver that reports -1 rows after executemany (and, with `drop`,
+    ## quietly loses the first row of each batch)
+    def __init__(self, connection, drop: bool = False):
+        super().__init__(connection)
+        self.drop = drop
+
+    def load(self, cursor, name, batch):
+        columns, rows = batch
+        super().load(cursor, name, (columns, rows[1:] if self.drop else rows))
+        return None
+
+
+def test_rowcount_verify_falls_back_to_a_count_when_the_driver_says_nothing(
+    tmp_path,
+):
+    db = offline_db(tmp_path)
+    engine = sqlite3.connect(":memory:", check_same_thread=False)
+    df = pd.DataFrame({"id": range(5)})
+
+    with pytest.warns(UserWarning, match="COUNT") as found:
+        db.write_table(
+            df, "t", method=UncountedBackend(engine), batch_size=2, verbose=False
+        )
+    assert len(found) == 1
+    assert list(db.upload_stats["rows"]) == [5]
+
+    ## Lost rows are caught by the count
+    with pytest.warns(UserWarning, match="sent 5 rows; started with 5 but 7"):
+        db.write_table(
+            df,
+            "t",
+            method=UncountedBackend(engine, drop=True),
+            append=True,
+            batch_size=2,
+            verbose=False,
+        )
+
+
+def make_token(tenant: str):
+    claims = base64.urlsafe_b64encode(json.dumps({"tid": tenant}).encode())
+    return "header." + claims.decode().rstrip("=") + ".signature"
+
+
+def test_background_token_refresh_asks_for_and_checks_the_tenant(tmp_path, monkeypatch):
+    asked = []
+
+    class Credential:
+        def __init__(self, tenant_id=None):
+            asked.append(tenant_id)
+
+        def get_token(self, resource):
+            return database.AccessToken(make_token("other"), 4102444800)
+
+    monkeypatch.setattr(database, "AzureCliCredential", Credential)
+    manager = _TokenManager.__new__(_TokenManager)
+    manager.tenant, manager.tenantid = "mine", "mine-id"
+    manager.resource = "https://database.windows.net/"
+    manager.path = str(tmp_path / "tokens.json")
+    manager.key = "key"
+
+    with pytest.raises(Exception, match="tenant `other` rather than `mine-id`"):
+        manager._fetch(interactive=False)
+    assert asked == ["mine-id"]
+    assert not (tmp_path / "tokens.json").exists()
+
+
+def test_connection_and_cursor_are_dedicated_and_stable(tmp_path):
+    db = offline_db(tmp_path)
+    db.cursor.execute("SELECT 1")
+    assert db.cursor.fetchall() == [(1,)]
+    assert db.connection is db.connection
+    with db._pool.connection() as pooled:
+        assert pooled is not db.connection
+    db.close()
+    assert db._direct is None
+
+
+def test_write_schema_checks_headers_and_creates_the_table(tmp_path):
+    db = offline_db(tmp_path)
+    db.tables = lambda to_list=False: [
+        x[0] for x in db._keep.execute("SELECT name FROM sqlite_master")
+    ]
+
+    with pytest.raises(Exception, match="column header with a space"):
+        db.write_schema(pd.DataFrame({"a b": [1]}), "t")
+
+    db.write_schema(make_frame(), "t", types="narrow")
+    columns = [x[1:3] for x in db._keep.execute("PRAGMA table_info(t)")]
+    assert columns[0] == ("id", "TINYINT")
+    assert [x[0] for x in columns] == list(make_frame().columns)
+
+
+def test_narrow_types_need_pinned_columns_for_streamed_sources(tmp_path):
+    db = offline_db(tmp_path)
+    engine = sqlite3.connect(":memory:", check_same_thread=False)
+    pages = lambda: iter([pd.DataFrame({"id": [1, 2]}), pd.DataFrame({"id": [900]})])
+
+    with pytest.raises(Exception, match="first page only"):
+        db.write_table(pages(), "t", method=LocalEngineBackend(engine), types="narrow")
+
+    db.write_table(
+        pages(),
+        "t",
+        method=LocalEngineBackend(engine),
+        types="narrow",
+        dtypes={"id": "INT"},
+        verbose=False,
+    )
+    assert engine.execute("SELECT MAX(id) FROM t").fetchone()[0] == 900
+
+
+def test_connection_pool_reuses_and_bounds_its_connections(tmp_path):
+    made = []
+    pool = _ConnectionPool(
+        lambda: made.append(sqlite3.connect(":memory:")) or made[-1], size=2
+    )
+
+    first, second = pool.acquire(), pool.acquire()
+    with pytest.raises(Exception, match="Timed out"):
+        pool.acquire(timeout=0.05)
+    pool.release(first)
+    with pool.connection() as connection:
+        assert connection is first.connection
+    assert len(made) == 2
+
+    pool.release(second)
+    pool.close()
+    with pytest.raises(Exception, match="closed"):
+        pool.acquire()
+
+
+def test_query_cache_round_trip_keys_and_expiry(tmp_path):
+    cache = _QueryCache(directory=str(tmp_path))
+    key = cache.key("select *  from a", params=[1])
+    assert key == cache.key("select * from a", params=[1])
+    assert key != cache.key("select * from a", params=[2])
+
+    cache.put("ns", key, make_frame())
+    pd.testing.assert_frame_equal(cache.get("ns", key), make_frame())
+    assert cache.get("other", key) is None
+
+    cache.ttl = -1
+    assert cache.get("ns", key) is None
+
+    cache.ttl = 60
+    cache.put("ns", key, make_frame())
+    cache.clear("ns")
+    assert cache.get("ns", key) is None
+
+
+def test_repage_cuts_and_glues_frames():
+    frames = [pd.DataFrame({"x": range(n)}) for n in [3, 1, 5]]
+    assert [x.shape[0] for x in _repage(iter(frames), 4)] == [4, 4, 1]
+
+    sizes = iter([2, 5, 5])
+    out = list(_repage(iter(frames), lambda: next(sizes)))
+    assert [x.shape[0] for x in out] == [2, 5, 2]
+    assert list(pd.concat(out)["x"]) == [0, 1, 2, 0, 0, 1, 2, 3, 4]
+
+
+def test_upload_source_pages_frames_tuples_and_files(tmp_path):
+    df = pd.DataFrame({"id": range(5), "name": list("abcde")})
+
+    source = _UploadSource(df, 2)
+    assert source.nrows == 5
+    assert [(s, e) for i, s, e, page in source.pages(skip={2})] == [(0, 2), (4, 5)]
+    assert source.sent == 3
+
+    rows = iter(df.itertuples(index=False, name=None))
+    source = _UploadSource(rows, 2, columns=["id", "name"])
+    pages = [page for i, s, e, page in source.pages()]
+    pd.testing.assert_frame_equal(pd.concat(pages, ignore_index=True), df)
+    with pytest.raises(Exception, match="columns"):
+        _UploadSource(iter([(1, "a")]), 2)
+
+    path = tmp_path / "rows.csv"
+    df.to_csv(path, index=False)
+    source = _UploadSource(str(path), 3, where=lambda x: x[x["id"] > 0])
+    ## Filtered CSV chunks are glued back into full pages
+    assert list(source.first["id"]) == [1, 2, 3]
+    assert [e - s for i, s, e, page in source.pages()] == [3, 1]
+    assert source.fingerprint().startswith(str(path))
+
+
+def test_upload_checkpoint_marks_journals_and_finishes(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    backend = LocalEngineBackend(sqlite3.connect(":memory:"))
+    checkpoint = _UploadCheckpoint(backend.execute, "abc", "t", remote=False)
+
+    cursor = backend.connection.cursor()
+    checkpoint.mark(cursor, 0, 10)
+    checkpoint.mark(cursor, 10, 20)
+    backend.connection.commit()
+    checkpoint.record(0, 10)
+    assert checkpoint.committed() == {0, 10}
+
+    assert not checkpoint.rerun
+
+    ## A rerun reads the journal back
+    again = _UploadCheckpoint(backend.execute, "abc", "t", remote=False)
+    assert again.rerun and again.journal["committed"] == [[0, 10]]
+
+    again.finish()
+    assert checkpoint.committed() == set()
+    assert not (tmp_path / ".ds_upload_journal" / "abc.json").exists()
+
+
+def test_fetch_pages_pages_then_closes_and_releases():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE a (x INT, y TEXT)")
+    connection.executemany(
+        "INSERT INTO a VALUES (?, ?)", [(i, str(i)) for i in range(5)]
+    )
+    released = []
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM a")
+    pages = list(_fetch_pages(cursor, 2, release=lambda: released.append(True)))
+    assert [x.shape[0] for x in pages] == [2, 2, 1]
+    assert list(pages[2]["y"]) == ["4"]
+    assert released == [True]
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM a WHERE x < 0")
+    pages = list(_fetch_pages(cursor, 2))
+    assert len(pages) == 1 and list(pages[0].columns) == ["x", "y"]
+
+
+@pytest.mark.parametrize("verify", ["rowcount", "count", "batch", "none"])
+def test_write_table_loads_through_a_local_engine(tmp_path, verify):
+    db = offline_db(tmp_path)
+    engine = sqlite3.connect(":memory:", check_same_thread=False)
+    df = make_frame()
+    kwargs = dict(batch_size=2, verify=verify, verbose=False)
+
+    db.write_table(df, "t", method=LocalEngineBackend(engine), **kwargs)
+    out = engine.execute("SELECT id, name FROM t ORDER BY id").fetchall()
+    assert out == [(1, "a"), (2, "it's"), (3, None)]
+    assert db.upload_stats["rows"].sum() == 3
+
+    db.write_table(
+        df, "t", method=LocalEngineBackend(engine), append=True, parallel=2, **kwargs
+    )
+    assert engine.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 6
+
+    db.write_table(df, "t", method=LocalEngineBackend(engine), overwrite=True, **kwargs)
+    assert engine.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 3
+
+
+def test_column_to_array_types_and_nulls():
+    rows = [(1, True, datetime.date(2024, 1, 2)), (2, None, None), (None, False, None)]
+
+    ints = _column_to_array(rows[:2], 0, int)
+    assert ints.dtype == "int64" and list(ints) == [1, 2]
+    ## Int columns with NULLs become float, as pandas does
+    ints = _column_to_array(rows, 0, int)
+    assert ints.dtype == "float64" and np.isnan(ints[2])
+
+    assert _column_to_array(rows[::2], 1, bool).dtype == "bool"
+    flags = _column_to_array(rows, 1, bool)
+    assert flags.dtype == object and list(flags) == [True, None, False]
+
+    dates = _column_to_array(rows, 2, datetime.date)
+    assert dates.dtype.kind == "M"
+    assert dates[0] == np.datetime64("2024-01-02")
+    assert np.isnat(dates[1])
+    assert _column_to_array([], 0, int).shape == (0,)
+
+
+def test_columns_resolve_a_name_found_in_two_schemas(tmp_path):
+    db = offline_db(tmp_path)
+    catalog = pd.DataFrame(
+        {
+            "TABLE_SCHEMA": ["dbo", "stage", "dbo", "stage", "stage", "dbo"],
+            "TABLE_NAME": ["S", "S", "S", "S", "S", "T"],
+            "COLUMN_NAME": ["id", "id", "name", "name", "loaded_at", "x"],
+            "ORDINAL_POSITION": [1, 1, 2, 2, 3, 1],
+        }
+    )
+    db._information_schema_columns = lambda: catalog
+    seen = []
+    db.query = lambda query: seen.append(query) or pd.DataFrame(columns=["id", "name"])
+
+    assert db.columns("T") == ["x"]
+    assert db.columns("S") == ["id", "name"]
+    assert seen == ["SELECT TOP 0 * FROM [S]"]
+
+
+def test_delimited_text_writes_floats_in_fixed_point():
+    df = pd.DataFrame(
+        {
+            "x": [1e-05, 1.5e17, 2.0, np.nan],
+            "n": pd.Series([1, None, 3, 4], dtype="float64"),
+            "f": np.array([0.1, 1, 2.5, 3], dtype="float32"),
+        }
+    )
+    rows = _delimited_text(df, ",", "\n").split("\n")
+    assert rows[:4] == [
+        "0.00001,1,0.1",
+        "150000000000000000,,1",
+        "2,3,2.5",
+        ",4,3",
+    ]
+
+
+def test_resume_reuses_the_table_a_failed_first_run_made(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    db = server_db(tmp_path, monkeypatch)
+    df = pd.DataFrame({"id": range(4)})
+    kwargs = dict(resume=True, batch_size=2, verbose=False)
+
+    ## The first run makes the table and fails before any batch commits
+    with pytest.raises(RuntimeError):
+        db.write_table(df, "t", method=ServerBackend(fail=1), **kwargs)
+    assert "t" in db.tables(to_list=True)
+
+    db.write_table(df, "t", method=ServerBackend(), **kwargs)
+    assert [x[0] for x in db._keep.execute("SELECT id FROM t")] == [0, 1, 2, 3]
+
+
+def test_resume_checks_the_permission_before_the_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    db = server_db(tmp_path, monkeypatch)
+    db._has_permission = lambda operation="CREATE TABLE": False
+
+    db.write_table(make_frame(), "t", method=ServerBackend(), resume=True)
+    assert db.tables(to_list=True) == []
+    assert not (tmp_path / ".ds_upload_journal").exists()
+
+
+def test_batch_verify_refuses_parallel_workers(tmp_path, monkeypatch):
+    db = server_db(tmp_path, monkeypatch)
+    with pytest.raises(Exception, match="verify = 'batch'"):
+        db.write_table(
+            make_frame(), "t", method=ServerBackend(), verify="batch", parallel=2
+        )
+    assert db.tables(to_list=True) == []
+
+
+def test_sample_rows_draws_unique_sorted_row_numbers():
+    out = _sample_rows(50, 60, seed=1)
+    assert len(set(out)) == 50 and out.min() >= 1 and out.max() <= 60
+    assert (np.diff(out) > 0).all()
+    assert (out == _sample_rows(50, 60, seed=1)).all()
+    assert list(_sample_rows(5, 5)) == [1, 2, 3, 4, 5]
+
+
+def test_upload_rows_convert_column_wise_without_mutating():
+    df = pd.DataFrame(
+        {
+            "i": [1, 2],
+            "b": [True, False],
+            "x": [1.5, np.nan],
+            "t": pd.to_datetime(["2024-01-02 03:04:05", None]),
+            "s": ["a", None],
+            "nb": pd.Series([True, None], dtype="boolean"),
+        }
+    )
+    before = df.copy()
+
+    rows = _upload_rows(df)
+    assert rows == [
+        (1, 1, 1.5, datetime.datetime(2024, 1, 2, 3, 4, 5), "a", 1),
+        (2, 0, None, None, None, None),
+    ]
+    assert type(rows[0][0]) is int and type(rows[0][2]) is float
+    assert _upload_rows(df.iloc[:1, 3:4], "%Y-%m-%d")[0] == ("2024-01-02",)
+    pd.testing.assert_frame_equal(df, before)